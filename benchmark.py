@@ -0,0 +1,355 @@
+#!/usr/bin/env python3
+#
+# Benchmarks for name_pryer.py.
+#
+# Generates a synthetic directory tree and times each stage of a run on it:
+# startup, listing, every action handler on its own, the fused action
+# pipeline, collision verification, preview printing and the renames.
+# Results are printed as a table and may be written to a JSON file, which a
+# later run can be compared against with --compare, e.g. to benchmark the
+# name_pryer.py of another commit with --module.
+#
+# Usage:
+#     python3 benchmark.py --files 100000 --depth 3 --output new.json
+#     git show HEAD~1:name_pryer.py > /tmp/old.py
+#     python3 benchmark.py --module /tmp/old.py --compare new.json
+
+import os
+import sys
+import time
+import json
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+import contextlib
+import importlib.util
+
+###############################################################################
+# GLOBALS
+
+WORDS = [
+    "alpha", "bravo", "charlie", "delta", "echo", "foxtrot", "golf", "hotel",
+    "india", "juliet", "kilo", "lima", "mike", "november", "oscar", "papa",
+    "quebec", "romeo", "sierra", "tango", "uniform", "victor", "whiskey",
+    "xray", "yankee", "zulu"
+]
+EXTENSIONS = ["txt", "mp3", "jpg", "tar.gz", "py", ""]
+SHAPES = ["snake", "camel", "spaces", "dotted", "mixed"]
+
+# Each action is run on its own, on a fresh buffer. -t is interactive and
+# is left out.
+ACTIONS = [
+    ["-c", "uc"],
+    ["-C"],
+    ["+C"],
+    ["-d", "0", "1"],
+    ["+e", "bak"],
+    ["-e", "dat"],
+    ["-F", "{first}"],
+    ["-i", "x", "0"],
+    ["-n"],
+    ["-p", "{X}.{C}", "{X}_{num4}.{C}"],
+    ["-p", "{X}", "{mdate}_{1}"],
+    ["-p", "{X}", "{1}_{rand0-9999999,7}"],
+    ["-r", "a", "4"],
+    ["-s", "us"],
+    ["-v", "1"]
+]
+# Actions of the pipeline, verify, print and rename stages.
+PIPELINE = ["-s", "us", "-c", "lc", "-r", "a", "4"]
+STAGES = ["startup", "listing", "actions", "pipeline", "verify", "print",
+          "rename"]
+
+
+###############################################################################
+# TREE GENERATION
+
+
+def make_name(shape, rng, i):
+    words = [rng.choice(WORDS) for n in range(rng.randint(1, 4))]
+    if shape == "mixed":
+        shape = SHAPES[i % (len(SHAPES) - 1)]
+    if shape == "snake":
+        name = "_".join(words)
+    elif shape == "camel":
+        name = "".join(w.capitalize() for w in words)
+    elif shape == "spaces":
+        name = " ".join(words)
+    else:
+        name = ".".join(words)
+    # The counter keeps the names unique, so that no action collides.
+    name = "{} {:07d}".format(name, i)
+    ext = rng.choice(EXTENSIONS)
+    return name + "." + ext if ext else name
+
+
+def tree_directories(root, depth, fanout):
+    dirs = [root]
+    level = [root]
+    for d in range(depth):
+        level = [os.path.join(parent, "dir_{}".format(n))
+                 for parent in level for n in range(fanout)]
+        dirs.extend(level)
+    return dirs
+
+
+def generate_tree(root, files, depth, fanout, shape, seed):
+    """ Create files empty files spread evenly over a tree of directories
+    depth levels deep with fanout subdirectories each. The same parameters
+    always give the same tree.
+    """
+    rng = random.Random(seed)
+    dirs = tree_directories(root, depth, fanout)
+    for d in dirs:
+        os.makedirs(d, exist_ok=True)
+    for i in range(files):
+        path = os.path.join(dirs[i % len(dirs)], make_name(shape, rng, i))
+        open(path, "w").close()
+    return dirs
+
+
+###############################################################################
+# TIMING
+
+
+def load_module(path):
+    spec = importlib.util.spec_from_file_location("name_pryer", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@contextlib.contextmanager
+def quiet():
+    # Output goes to /dev/null, which still pays for formatting and writes.
+    with open(os.devnull, "w") as devnull:
+        with contextlib.redirect_stdout(devnull):
+            yield
+
+
+def time_runs(repeat, run, setup=None, teardown=None):
+    """ Time run(*setup()) repeat times, leaving setup and teardown out. """
+    times = []
+    for n in range(repeat):
+        args = setup() if setup is not None else ()
+        with quiet():
+            start = time.perf_counter()
+            run(*args)
+            times.append(time.perf_counter() - start)
+        if teardown is not None:
+            teardown()
+    return times
+
+
+def summarize(times, entries):
+    times = sorted(times)
+    median = times[len(times) // 2]
+    return {
+        "min": times[0],
+        "median": median,
+        "times": times,
+        "entries": entries,
+        "entries_per_second": entries / median if median else None
+    }
+
+
+class Bench:
+
+    def __init__(self, module, module_path, args, root):
+        self.np = module
+        self.module_path = module_path
+        self.args = args
+        self.root = root
+        self.first = None
+
+    def argv(self, flags):
+        argv = ["name_pryer", "-y", "-v", "0", "-D", self.root]
+        if self.args.recursive:
+            argv.append("-R")
+        if self.args.jobs > 1:
+            argv.extend(["-j", str(self.args.jobs)])
+        return argv + [f.replace("{first}", self.first) for f in flags]
+
+    def parse(self, flags):
+        config, actions = self.np.parse_args(self.argv(flags))
+        return config, actions
+
+    def buffer(self, flags):
+        config, actions = self.parse(flags)
+        return config, actions, self.np.init_fn_buffer(config)
+
+    def run_startup(self):
+        argv = [sys.executable, self.module_path, "-h"]
+
+        def run():
+            subprocess.run(argv, stdout=subprocess.DEVNULL, check=True)
+        return {"startup": summarize(time_runs(self.args.repeat, run), 1)}
+
+    def run_listing(self):
+        config, actions = self.parse([])
+        entries = len(self.np.init_fn_buffer(config))
+        times = time_runs(self.args.repeat, self.np.init_fn_buffer,
+                          lambda: (self.parse([])[0],))
+        return {"listing": summarize(times, entries)}
+
+    def run_actions(self):
+        results = {}
+        for flags in ACTIONS:
+            name = "action " + " ".join(flags)
+
+            def setup():
+                config, actions, fn_buffer = self.buffer(flags)
+                return config, actions[-1], fn_buffer
+
+            def run(config, action, fn_buffer):
+                self.np.ACTION_HANDLERS[action.name](config, action,
+                                                     fn_buffer)
+            entries = len(self.buffer(flags)[2])
+            times = time_runs(self.args.repeat, run, setup)
+            results[name] = summarize(times, entries)
+        return results
+
+    def run_pipeline(self):
+        entries = len(self.buffer([])[2])
+        times = time_runs(self.args.repeat, self.np.handle_actions,
+                          lambda: self.parse(PIPELINE))
+        return {"pipeline": summarize(times, entries)}
+
+    def processed(self):
+        config, actions = self.parse(PIPELINE)
+        with quiet():
+            fn_buffer = self.np.handle_actions(config, actions)
+        return config, fn_buffer
+
+    def run_verify(self):
+        config, fn_buffer = self.processed()
+        times = time_runs(self.args.repeat, self.np.verify_fn_buffer,
+                          lambda: (fn_buffer,))
+        return {"verify": summarize(times, len(fn_buffer))}
+
+    def run_print(self):
+        config, fn_buffer = self.processed()
+        times = time_runs(self.args.repeat, self.np.print_fn_buffer,
+                          lambda: (config, fn_buffer))
+        return {"print": summarize(times, len(fn_buffer))}
+
+    def run_rename(self):
+        # The tree is generated again after each run.
+        entries = len(self.processed()[1])
+        times = time_runs(self.args.repeat, self.np.rename_files,
+                          self.processed, self.regenerate)
+        return {"rename": summarize(times, entries)}
+
+    def regenerate(self):
+        shutil.rmtree(self.root)
+        self.generate()
+
+    def generate(self):
+        a = self.args
+        generate_tree(self.root, a.files, a.depth, a.fanout, a.shape, a.seed)
+        self.first = sorted(os.listdir(self.root))[0]
+
+
+###############################################################################
+# OUTPUT
+
+
+def print_results(results, baseline=None):
+    stages = results["stages"]
+    old = baseline["stages"] if baseline is not None else {}
+    width = max(len(name) for name in stages)
+    header = "{:<{}}  {:>10}  {:>10}  {:>12}".format(
+        "stage", width, "min (s)", "median (s)", "entries/s")
+    if old:
+        header += "  {:>10}  {:>7}".format("base (s)", "ratio")
+    print(header)
+    for name, r in stages.items():
+        rate = r["entries_per_second"]
+        line = "{:<{}}  {:>10.4f}  {:>10.4f}  {:>12}".format(
+            name, width, r["min"], r["median"],
+            "{:.0f}".format(rate) if rate is not None else "-")
+        if name in old:
+            base = old[name]["median"]
+            ratio = r["median"] / base if base else float("inf")
+            line += "  {:>10.4f}  {:>7.2f}".format(base, ratio)
+        print(line)
+
+
+def parse_args(argv):
+    here = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(
+        description="Benchmark name_pryer.py on a synthetic tree.")
+    parser.add_argument("--module", default=os.path.join(here,
+                                                          "name_pryer.py"),
+                        help="name_pryer.py to benchmark")
+    parser.add_argument("--files", type=int, default=10000)
+    parser.add_argument("--depth", type=int, default=0,
+                        help="levels of subdirectories, 0 for a flat tree")
+    parser.add_argument("--fanout", type=int, default=4,
+                        help="subdirectories in each directory")
+    parser.add_argument("--shape", choices=SHAPES, default="mixed",
+                        help="shape of the generated names")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="passed to name_pryer.py as -j")
+    parser.add_argument("--stages", default=",".join(STAGES),
+                        help="comma separated, from: " + ", ".join(STAGES))
+    parser.add_argument("--dir", default=None,
+                        help="where to generate the tree, /dev/shm if "
+                        "available")
+    parser.add_argument("--output", help="write the results as JSON")
+    parser.add_argument("--compare", help="JSON results to compare against")
+    args = parser.parse_args(argv[1:])
+    args.recursive = args.depth > 0
+    for stage in args.stages.split(","):
+        if stage not in STAGES:
+            parser.error("unknown stage: {}".format(stage))
+    return args
+
+
+def main():
+    args = parse_args(sys.argv)
+    base = args.dir
+    if base is None and os.path.isdir("/dev/shm"):
+        base = "/dev/shm"
+    tmp = tempfile.mkdtemp(prefix="np-bench.", dir=base)
+    root = os.path.join(tmp, "tree")
+    module_path = os.path.abspath(args.module)
+    try:
+        bench = Bench(load_module(module_path), module_path, args, root)
+        bench.generate()
+        stages = {}
+        for stage in args.stages.split(","):
+            stages.update(getattr(bench, "run_" + stage)())
+    finally:
+        shutil.rmtree(tmp)
+
+    results = {
+        "module": module_path,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "tree": {
+            "files": args.files, "depth": args.depth, "fanout": args.fanout,
+            "shape": args.shape, "seed": args.seed
+        },
+        "jobs": args.jobs,
+        "repeat": args.repeat,
+        "stages": stages
+    }
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+            f.write("\n")
+
+
+if (__name__ == "__main__"):
+    main()
@@ -20,11 +20,10 @@ import os
 import re
 import sys
 import time
-import glob
-import tty
-import termios
+import fnmatch
 import functools
-import subprocess
+import threading
+import collections
 
 ###############################################################################
 # GLOBALS
@@ -34,11 +33,29 @@ Usage:
     -h
     -v [0 | 1 | 2 | 3]
     --git
+    --stream
+    --watch
+    --poll SECONDS
+    --manifest FILE
+    --seed SEED
+    --num-scope [global | dir | ext]
+    --journal FILE
+    --resume FILE
+    --index FILE
+    --no-pager
     -y
     -u
+    --undo FILE
+    --stats
+    --stats-json FILE
+    --profile FILE
+    --plan-json FILE
+    --plan-nul FILE
     -F FILENAME
     -D DIR
     -R
+    -j JOBS
+    -P PROCESSES
     -M [f | d | b]
     -g GLOB
     -p SOURCE_PATTERN DESTINATION_PATTERN
@@ -47,6 +64,7 @@ Usage:
         {C}                      {date}                           {day}
         {X}                      {year}                           {dayname}
         {@}                      {month}                          {daysimp}
+                                 {time}                           {m...} {c...}
     -c [lc | uc | tc | sc]
     -C
     +C
@@ -74,17 +92,78 @@ Usage:
         Counts as an action, so several may be present between other actions
         to raise or lower the verbosity during operation.
     --git
-        Make filename modifications by calling git instead of directly.
+        Make filename modifications through git: tracked files are renamed
+        and the git index is updated in one step.
+    --stream
+        Process directories in chunks with bounded memory, for directories
+        too large to hold in memory. Entries are not sorted, and {num}
+        fields, -v 3, -u and --git are not available. Duplicates are only
+        checked on the final names.
+    --watch
+        Keep running, and rename the entries created in or moved into the
+        directory, or the tree with -R, as they arrive. Entries already
+        there are left alone, and renames are made without confirmation.
+        Date fields of -p are those of the moment the watch started.
+    --poll SECONDS
+        With --watch, look for new entries every SECONDS instead of being
+        notified by inotify, e.g. on network file systems.
+    --manifest FILE
+        Run several jobs over a single listing of the directory. Each line
+        of FILE holds the -g and -M filters and the actions of one job, as
+        on the command line. The jobs are applied in order, after those of
+        the command line, as if they were separate runs, and all the
+        renames are checked and made together.
+    --seed SEED
+        Seed for the {rand} fields of -p, so that a run can be repeated with
+        the same random numbers.
+    --num-scope [global | dir | ext]
+        What {num} fields of -p count: all the files (default), the files
+        in each directory, or the files with each extension.
+    --journal FILE
+        Record the planned renames in FILE before starting, and each rename
+        as it completes. If the run is interrupted, --resume FILE applies
+        the renames that were left.
+    --resume FILE
+        Apply the renames left over in the journal FILE of an interrupted
+        run. No actions are needed.
+    --index FILE
+        Keep the listing of each directory in FILE, and on later runs list
+        again only the directories that changed since.
+    --no-pager
+        Print the whole preview before asking for confirmation, instead of
+        paging through it when it does not fit on the terminal.
     -y
         Yes mode, do not prompt for confirmation.
     -u
-        Creates an undo script.
+        Creates an undo script, undo.sh, which can be run with sh or
+        replayed with --undo undo.sh.
+    --undo FILE
+        Undo the renames recorded in the undo script FILE. No actions are
+        needed.
+    --stats
+        Print the time, entries processed and changed, and file system calls
+        of each stage of the run to stderr.
+    --stats-json FILE
+        Write the same statistics to FILE as JSON.
+    --profile FILE
+        Profile the run with cProfile and write the statistics to FILE.
+    --plan-json FILE
+        Write each planned rename to FILE, - for the standard output, as a
+        line of JSON with the old and new paths and the actions that
+        changed the entry, as soon as the entry is processed.
+    --plan-nul FILE
+        Same, as the old and new paths each followed by a NUL character.
     -F FILENAME
         Run on file FILENAME
     -D DIR
         Specify the working directory.
     -R
         Recurse directories.
+    -j JOBS
+        Number of threads used to list directories when recursing and to
+        rename files.
+    -P PROCESSES
+        Number of processes used to apply the actions to large buffers.
     -M [f | d | b]
         f: operate only on files (default)
         d: operate only on directories
@@ -99,7 +178,8 @@ Usage:
         {X}         Numbers, letters, and spaces
         {@}         Trash
         {numX+Y}    Number, padded to X characters with leading 0s, step by Y
-        {randX-Y,Z} Random number between X and Y padded to Z characters
+        {randX-Y,Z} Random number between X and Y padded to Z characters,
+                    different for each file while the range allows
         {date}      Date (2014-12-31)
         {year}      Year (2014)
         {month}     Month number (12)
@@ -108,6 +188,12 @@ Usage:
         {day}       Day number (31)
         {dayname}   Day name (Wednesday)
         {daysimp}   Day simple name (Wed)
+        {time}      Time (23-59-59)
+        {mdate}, {myear}, ... {mtime}
+                    The same fields for the modification time of the file
+        {cdate}, {cyear}, ... {ctime}
+                    The same fields for the creation time of the file, or
+                    the time its status last changed where it is not kept
     -c [lc | uc | tc | sc]
         Change case:
             lc: lowercase
@@ -172,12 +258,47 @@ ERRMSGS = {
     "too_many_tokens": "a file has too many tokens",
     "filemode-arity": "-m requires one parameter",
     "directory-arity": "-D requires one parameter",
-    "glob-arity": "-g requires one parameter"
+    "glob-arity": "-g requires one parameter",
+    "glob-directory": "wildcards in -g can only be used in the entry name: {}",
+    "jobs-arity": "-j requires one parameter",
+    "jobs-type": "parameter to -j must be a positive integer",
+    "processes-arity": "-P requires one parameter",
+    "processes-type": "parameter to -P must be a positive integer",
+    "pattern-invalid": "invalid source pattern for -p: {}",
+    "stream-unsupported": "{} cannot be used with --stream",
+    "journal-arity": "--journal requires one parameter",
+    "journal-git": "--journal cannot be used with --git",
+    "resume-arity": "--resume requires one parameter",
+    "resume-invalid": "not a name pryer journal: {}",
+    "index-arity": "--index requires one parameter",
+    "watch-unsupported": "{} cannot be used with --watch",
+    "poll-arity": "--poll requires one parameter",
+    "poll-type": "parameter to --poll must be a positive number",
+    "poll-watch": "--poll can only be used with --watch",
+    "manifest-arity": "--manifest requires one parameter",
+    "manifest-invalid": "{}, line {}: {}",
+    "manifest-option": "{}, line {}: only -g, -M and actions can be used in "
+                       "a manifest",
+    "manifest-glob": "-g cannot have a directory with --manifest: {}",
+    "undo-arity": "--undo requires one parameter",
+    "undo-invalid": "not a name pryer undo script: {}",
+    "stats-arity": "--stats-json requires one parameter",
+    "plan-arity": "{} requires one parameter",
+    "plan-unsupported": "{} cannot be used with --plan-json or --plan-nul",
+    "profile-arity": "--profile requires one parameter",
+    "seed-arity": "--seed requires one parameter",
+    "seed-type": "parameter to --seed must be an integer",
+    "num-scope-arity": "--num-scope requires one parameter",
+    "num-scope-type": "valid parameters for --num-scope: global dir ext"
 }
 
 VALID_FLAGS = frozenset([
-    "-c", "-C", "+C", "-d", "-D", "-e", "+e", "-F", "-g", "-h", "-i", "-M",
-    "-n", "-p", "-r", "-R", "-s", "-u", "-v", "-y"
+    "-c", "-C", "+C", "-d", "-D", "-e", "+e", "-F", "-g", "-h", "-i", "-j",
+    "-M", "-n", "-p", "-P", "-r", "-R", "-s", "-t", "-u", "-v", "-y",
+    "--git", "--index", "--journal", "--manifest", "--no-pager",
+    "--num-scope", "--plan-json", "--plan-nul", "--poll", "--profile",
+    "--resume", "--seed", "--stats", "--stats-json", "--stream", "--undo",
+    "--watch"
     ])
 VALID_SUBTITUTION_OPTIONS = frozenset([
     "sd", "sp", "su", "ud", "up", "us", "pd", "ps", "pu", "dp", "ds", "du"
@@ -188,9 +309,55 @@ SPLIT_REGEX = re.compile(r"[a-zA-Z0-9]+|[^a-zA-Z0-9]+")
 FIRST_CAP_REGEX = re.compile(r"(.)([A-Z][a-z]+)")
 ALL_CAP_REGEX = re.compile(r"([a-z0-9])([A-Z])")
 ALPHANUMERIC_REGEX = re.compile(r"[a-zA-Z0-9]+")
+TEMPLATE_FIELD_REGEX = re.compile(r"\{([^{}]*)\}")
+NUM_FIELD_REGEX = re.compile(r"num([0-9]*)(?:\+([0-9]*))?")
+RAND_FIELD_REGEX = re.compile(r"rand([0-9]*)(?:-([0-9]+))?(?:,([0-9]+))?")
+GLOB_MAGIC_REGEX = re.compile(r"[*?[]")
+RAND_BATCH = 1024
+PARALLEL_CHUNK = 20000
+# Lines of undo scripts, with names quoted as by shlex.quote.
+UNDO_TOKEN = r"((?:'[^']*'|\"'\"|[^\s'\"])+)"
+UNDO_RECORD_REGEX = re.compile("mv -- {0} {0}\n".format(UNDO_TOKEN))
+UNDO_COMMENT_REGEX = re.compile(r"(?:#[^\n]*)?\n")
+UNDO_QUOTE_REGEX = re.compile(r"'([^']*)'|\"(')\"|([^'\"]+)")
+UNDO_HEADER = "# name pryer undo script"
+
+# Characters escaped in -p source patterns, followed by the field expansions.
+PATTERN_ESCAPES = [
+    (".", r"\."), ("[", r"\["), ("]", r"\]"), ("(", r"\("), (")", r"\)"),
+    ("?", r"\?")
+]
+PATTERN_FIELDS = [
+    ("{#}", r"([0-9]*)"), ("{L}", r"([a-zA-Z]*)"), ("{C}", r"([\S]*)"),
+    ("{X}", r"([\S\s]*)"), ("{@}", r"(.*)")
+]
+DATE_FIELDS = {
+    "date": "%Y-%m-%d",
+    "year": "%Y",
+    "month": "%m",
+    "monthname": "%B",
+    "monthsimp": "%b",
+    "day": "%d",
+    "dayname": "%A",
+    "daysimp": "%a",
+    "time": "%H-%M-%S"
+}
+# Date fields of the file's own times: the index in the (mtime, ctime) pair
+# kept in config.file_times, and the format.
+FILE_DATE_FIELDS = {
+    prefix + field: (index, fmt)
+    for index, prefix in enumerate("mc") for field, fmt in DATE_FIELDS.items()
+}
+
+OUTPUT_LOCK = threading.Lock()
+DIRECTORIES = {}
 
 ACTION_HANDLERS = {}
+ACTION_STEPS = {}
+NUM_SCOPES = {}
 CASE_FUNS = {}
+# the steps of each pooled segment, in worker processes
+WORKER_STEPS = []
 SUBSTITUTE_FUNS = {}
 
 
@@ -201,9 +368,8 @@ SUBSTITUTE_FUNS = {}
 class Config:
 
     def __init__(self):
-        rows, cols = os.popen('stty size', 'r').read().split()
-        self.rows = int(rows)
-        self.cols = int(cols)
+        # The terminal size is only looked up when output needs it.
+        self.terminal_size = None
         # 0: silent running
         # 1: default, show file name buffer before confirmation
         # 2: verbose, show actions and file name buffer before confirmation
@@ -211,11 +377,72 @@ class Config:
         self.verbosity = 1
         self.file_mode = 'f'
         self.yes_mode = False
+        # page through previews larger than the terminal
+        self.pager = True
         self.undo = False
         self.recursive = False
+        self.jobs = 1
+        # processes applying the actions, see handle_actions_parallel
+        self.processes = 1
         self.directory = os.getcwd()
         self.pattern = None
+        # Date fields of all -p actions refer to the same moment.
+        self.now = time.localtime()
+        # --seed, and the generator shared by all {rand} fields
+        self.seed = None
+        self.rng = None
+        # what {num} fields count: global, dir or ext
+        self.num_scope = "global"
+        # (mtime, ctime) of each listed entry by path, only when -p uses them
+        self.file_times = None
         self.git_mode = False
+        self.stream = False
+        # --watch, and the --poll interval in seconds
+        self.watch = False
+        self.poll = None
+        # --manifest of jobs to run over one listing
+        self.manifest = None
+        # --journal and --resume file names, and the journal being written.
+        self.journal_file = None
+        self.resume = None
+        self.journal = None
+        # --index directory listing database
+        self.index_file = None
+        # undo script to replay
+        self.replay = None
+        # --stats, --stats-json and --profile, and the Stats being collected
+        self.stats_table = False
+        self.stats_file = None
+        self.profile = None
+        self.stats = None
+        # --plan-json or --plan-nul file and format, and the PlanWriter
+        self.plan_file = None
+        self.plan_format = None
+        self.plan = None
+        # names of the entries in each directory scanned by get_file_listing
+        self.snapshot = {}
+
+    @property
+    def rows(self):
+        return self.get_terminal_size().lines
+
+    @property
+    def cols(self):
+        return self.get_terminal_size().columns
+
+    def random(self):
+        if self.rng is None:
+            import random
+            self.rng = random.Random(self.seed)
+        return self.rng
+
+    def get_terminal_size(self):
+        # Asks the terminal directly instead of running stty, and falls back
+        # to 80x24 when there is no terminal, e.g. under cron.
+        if self.terminal_size is None:
+            import shutil
+            self.terminal_size = shutil.get_terminal_size()
+        return self.terminal_size
 
 
 class Action:
@@ -226,10 +453,17 @@ class Action:
 
 
 class File:
-    def __init__(self, path, name, ext=""):
+    # Buffers may hold millions of these, so there is no per-instance dict.
+    # path is the interned directory string shared by all the entries in a
+    # directory, and orig is the entry's original name, which also serves as
+    # the buffer key.
+    __slots__ = ("path", "name", "ext", "orig")
+
+    def __init__(self, path, name, ext="", orig=None):
         self.path = path
         self.name = name
         self.ext = ext
+        self.orig = self.full() if orig is None else orig
 
     def full(self):
         if self.ext:
@@ -243,6 +477,13 @@ class File:
         else:
             return os.path.join(self.path, self.name)
 
+    def origpath(self):
+        return self.path + self.orig
+
+    def target(self):
+        # Same identity as fullpath(), without building the whole path.
+        return (self.path, self.full())
+
     def set_name(self, name):
         self.name = name
 
@@ -250,6 +491,174 @@ class File:
         self.ext = ext
 
 
+class CollisionIndex:
+    """ Detects buffer entries renamed to the same target.
+
+    refresh() follows entries whose names keep changing, counting the entries
+    per target. add() records entries seen once, as in a single pass over the
+    buffer, keeping only the names per directory, so that no full path is
+    built, and returns False as soon as a target is taken twice.
+    """
+
+    def __init__(self):
+        self.targets = {}
+        self.counts = {}
+        self.duplicates = set()
+        self.names = {}
+
+    def add(self, f):
+        names = self.names.get(f.path)
+        if names is None:
+            names = self.names[f.path] = set()
+        name = f.full()
+        if name in names:
+            return False
+        names.add(name)
+        return True
+
+    def refresh(self, key, f):
+        new = f.target()
+        old = self.targets.get(key)
+        if old == new:
+            return
+        if old is not None:
+            self.release(old)
+        self.targets[key] = new
+        n = self.counts.get(new, 0) + 1
+        self.counts[new] = n
+        if n > 1:
+            self.duplicates.add(new)
+
+    def discard(self, key):
+        old = self.targets.pop(key, None)
+        if old is not None:
+            self.release(old)
+
+    def release(self, target):
+        n = self.counts[target] - 1
+        if n:
+            self.counts[target] = n
+        else:
+            del self.counts[target]
+        if n < 2:
+            self.duplicates.discard(target)
+
+    def sync(self, fn_buffer):
+        if len(self.targets) > len(fn_buffer):
+            for k in [k for k in self.targets if k not in fn_buffer]:
+                self.discard(k)
+        for k, v in fn_buffer.items():
+            self.refresh(k, v)
+
+    def first_duplicate(self):
+        """ Return the target name of the first entry, in buffer order, that
+        shares its target with another entry, or None.
+        """
+        if self.duplicates:
+            for k, target in self.targets.items():
+                if target in self.duplicates:
+                    return target[1]
+        return None
+
+
+class PatternMatcher:
+    """ A -p source pattern and destination template, compiled once.
+
+    The destination template is kept as a list of segments: literal strings,
+    group indexes and (width, offset) tuples for {num} fields, so that each
+    file only needs a regex search and a join.
+    """
+
+    def __init__(self, source, destination, now=None, make_rng=None):
+        try:
+            self.regex = re.compile(translate_pattern(source))
+        except re.error:
+            sys.exit(ERRMSGS["pattern-invalid"].format(source))
+        if now is None:
+            now = time.localtime()
+        self.segments = compile_template(destination, self.regex.groups, now,
+                                         make_rng)
+
+    def uses_counter(self):
+        return any(type(seg) is tuple for seg in self.segments)
+
+    def uses_file_dates(self):
+        return any(type(seg) is FileDateField for seg in self.segments)
+
+    def match(self, name, count, times=None):
+        search = self.regex.search(name)
+        if not search:
+            return None
+        groups = search.groups()
+        parts = []
+        for seg in self.segments:
+            if type(seg) is str:
+                parts.append(seg)
+            elif type(seg) is int:
+                parts.append(groups[seg] or "")
+            elif type(seg) is tuple:
+                parts.append(format_num_field(count, *seg))
+            else:
+                parts.append(seg.value(times))
+        return "".join(parts)
+
+
+class FileDateField:
+    """ A date field of the modification or creation time of each file. """
+    __slots__ = ("index", "fmt")
+
+    def __init__(self, index, fmt):
+        self.index = index
+        self.fmt = fmt
+
+    def value(self, times):
+        return time.strftime(self.fmt, time.localtime(times[self.index]))
+
+
+class RandomField:
+    """ A {rand} field. Numbers are drawn without replacement, so that each
+    file gets a different one until the whole range has been used, and are
+    generated RAND_BATCH at a time.
+
+    Draws are a Fisher-Yates shuffle of the range done lazily: swaps holds
+    the positions moved so far, so memory grows with the numbers drawn and
+    not with the size of the range.
+    """
+    __slots__ = ("low", "size", "width", "rng", "drawn", "swaps", "batch")
+
+    def __init__(self, low, high, width, rng):
+        self.low = min(low, high)
+        self.size = abs(high - low) + 1
+        self.width = width
+        self.rng = rng
+        self.drawn = 0
+        self.swaps = {}
+        self.batch = []
+
+    def value(self, times):
+        if not self.batch:
+            self.fill()
+        return self.batch.pop()
+
+    def fill(self):
+        randrange = self.rng.randrange
+        swaps = self.swaps
+        batch = []
+        for n in range(RAND_BATCH):
+            if self.drawn == self.size:
+                # The range is used up, numbers repeat from here on.
+                self.drawn = 0
+                swaps.clear()
+            i = self.drawn
+            j = randrange(i, self.size)
+            picked = swaps.get(j, j)
+            swaps[j] = swaps.pop(i, i)
+            self.drawn += 1
+            batch.append(str(self.low + picked).zfill(self.width))
+        batch.reverse()
+        self.batch = batch
+
+
 ###############################################################################
 # FILE AND BUFFER HANDLING
 
@@ -259,132 +668,1952 @@ def escape_pattern(pattern):
     return pattern.replace("[", "[[]")
 
 
-def get_file_listing(config):
-    cwd = config.directory
-    result = []
-    items = []
-
-    if config.recursive:
-        if config.pattern:
-            for root, subfolders, files in os.walk(cwd):
-                items += glob.glob(os.path.join(root, config.pattern))
-        else:
-            for root, subfolders, files in os.walk(cwd):
-                for item in subfolders:
-                    items.append(os.path.join(root, item))
-                for item in files:
-                    items.append(os.path.join(root, item))
+def get_file_listing(config, dirs=None):
+    """ Generate File objects for the entries selected by the configuration.
+
+    Listing is done with os.scandir, relying on the type information of each
+    directory entry instead of a stat per path, and the working directory is
+    made absolute only once. Entries are sorted case insensitively by path.
+    The names found in each scanned directory are kept in config.snapshot,
+    and the File objects of directories are added to dirs if given.
+
+    A -g pattern with a directory part selects the entries of that
+    directory, or with -R those of every directory of that name in the tree.
+    """
+    root = os.path.abspath(config.directory)
+    subdir, pattern = split_glob(config.pattern)
+    match = compile_glob(pattern)
+    exts = {}
+    config.snapshot = {}
+    index = None
+    if (config.index_file is not None) and (config.file_times is None):
+        # File times change without their directory changing, so they are
+        # never taken from the index.
+        index = DirectoryIndex(config.index_file)
+        scan = functools.partial(scan_indexed_directory, match=match,
+                                 file_mode=config.file_mode, index=index)
     else:
-        if config.pattern:
-            items = glob.glob(os.path.join(config.directory, config.pattern))
-        else:
-            items = os.listdir(config.directory)
-        items = [os.path.join(config.directory, item) for item in items]
-
-    items.sort(key=str.lower)
-    if config.file_mode == 'f':
-        # Get files
-        for item in items:
-            abspath = os.path.abspath(item)
-            if not os.path.isdir(abspath):
-                path, name = os.path.split(abspath)
-                path += os.sep
-                name, ext = os.path.splitext(name)
-                result.append(File(path, name, ext[1:]))
-
-    elif config.file_mode == 'd':
-        # Get directories
-        for item in items:
-            abspath = os.path.abspath(item)
-            if os.path.isdir(abspath):
-                path, name = os.path.split(abspath)
-                path += os.sep
-                result.append(File(path, name, ""))
-
-    elif config.file_mode == 'b':
-        # Get both
-        for item in items:
-            abspath = os.path.abspath(item)
-            path, name = os.path.split(abspath)
-            path += os.sep
-            if os.path.isdir(abspath):
-                result.append(File(path, name, ""))
-            else:
-                name, ext = os.path.splitext(name)
-                result.append(File(path, name, ext[1:]))
-
-    return result
-
-
-def init_fn_buffer(config):
+        scan = functools.partial(scan_directory, match=match,
+                                 file_mode=config.file_mode,
+                                 times=config.file_times)
+    if config.recursive and config.jobs > 1:
+        entries = walk_directory_parallel(root, scan, config.snapshot,
+                                          config.jobs)
+        entries.sort(key=lambda e: (e[0] + e[1]).lower())
+    elif config.recursive:
+        entries = walk_directory(root, scan, config.snapshot)
+        entries.sort(key=lambda e: (e[0] + e[1]).lower())
+    elif subdir and not os.path.isdir(os.path.join(root, subdir)):
+        entries = []
+    else:
+        dirpath = os.path.normpath(os.path.join(root, subdir))
+        path = intern_directory(os.path.join(dirpath, ""))
+        names, subdirs, listed = scan(dirpath)
+        config.snapshot[path] = listed
+        entries = [(path, name, is_dir) for name, is_dir in names]
+        entries.sort(key=lambda e: e[1].lower())
+    start = len(os.path.join(root, ""))
+    if config.recursive and subdir:
+        # The directories below the root whose path ends with the pattern's.
+        suffix = os.path.join(os.sep, subdir, "")
+        entries = [e for e in entries
+                   if (os.sep + e[0][start:]).endswith(suffix)]
+    if config.git_mode:
+        # The repository itself is never renamed.
+        entries = [e for e in entries
+                   if ".git" not in (e[0][start:] + e[1]).split(os.sep)]
+    if index is not None:
+        index.close(root if config.recursive else None)
+    # Entries are released as they are turned into File objects.
+    entries.reverse()
+    while entries:
+        path, orig, is_dir = entries.pop()
+        f = make_file(path, orig, is_dir, exts)
+        if is_dir and (dirs is not None):
+            dirs.add(f)
+        yield f
+
+
+def make_file(path, orig, is_dir, exts):
+    # exts maps each extension found to a single shared string.
+    if is_dir:
+        return File(path, orig, "", orig)
+    name, ext = os.path.splitext(orig)
+    ext = exts.setdefault(ext, ext[1:])
+    return File(path, name, ext, orig)
+
+
+def intern_directory(path):
+    """ Return the canonical copy of a directory path, so that each directory
+    is stored once however many entries and tables refer to it.
+    """
+    return DIRECTORIES.setdefault(path, path)
+
+
+def split_glob(pattern):
+    """ Split a -g pattern into its directory part, relative to the listed
+    directory, or "" if it has none, and the pattern of entry names.
+    """
+    if pattern is None:
+        return "", None
+    head, tail = os.path.split(pattern)
+    if not head:
+        return "", pattern
+    return os.path.normpath(head), tail or None
+
+
+def compile_glob(pattern):
+    # Same semantics as matching with glob: names starting with a period are
+    # only matched by patterns that start with a period.
+    if not pattern:
+        return None
+    regex = re.compile(fnmatch.translate(pattern))
+    hidden = pattern.startswith(".")
+
+    def match(name):
+        return (hidden or name[0] != ".") and regex.match(name) is not None
+    return match
+
+
+def scan_directory(dirpath, match, file_mode, times=None):
+    """ Return the (name, is_dir) pairs selected in a directory, the paths of
+    the subdirectories to descend into when recursing and the set of all the
+    names in the directory. If times is a dict, the (mtime, ctime) of each
+    selected entry is stored in it by path.
+    """
+    names = []
+    subdirs = []
+    listed = set()
+    with os.scandir(dirpath) as it:
+        for entry in it:
+            listed.add(entry.name)
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            if is_dir and not entry.is_symlink():
+                subdirs.append(entry.path)
+            if (match is not None) and not match(entry.name):
+                continue
+            if not ((file_mode == 'b') or ((file_mode == 'd') == is_dir)):
+                continue
+            if times is not None:
+                try:
+                    times[entry.path] = entry_times(entry)
+                except OSError:
+                    continue
+            names.append((entry.name, is_dir))
+    return names, subdirs, listed
+
+
+def file_times(config, f):
+    # Normally captured while listing; stat is only needed for buffers that
+    # were listed without them.
+    path = f.origpath()
+    if (config.file_times is not None) and (path in config.file_times):
+        return config.file_times[path]
+    st = os.lstat(path)
+    return (st.st_mtime, getattr(st, "st_birthtime", st.st_ctime))
+
+
+def entry_times(entry):
+    # The creation time where the platform keeps it, otherwise the time the
+    # status last changed, as st_ctime is on Unix.
+    st = entry.stat(follow_symlinks=False)
+    return (st.st_mtime, getattr(st, "st_birthtime", st.st_ctime))
+
+
+def walk_directory(root, scan, snapshot):
+    # Like os.walk, symbolic links to directories are listed but not followed
+    # and directories that cannot be read are skipped.
+    entries = []
+    pending = [root]
+    while pending:
+        dirpath = pending.pop()
+        try:
+            names, subdirs, listed = scan(dirpath)
+        except OSError:
+            continue
+        path = intern_directory(os.path.join(dirpath, ""))
+        snapshot[path] = listed
+        entries.extend((path, name, is_dir) for name, is_dir in names)
+        pending.extend(subdirs)
+    return entries
+
+
+def walk_directory_parallel(root, scan, snapshot, jobs):
+    # Directory listings are fetched concurrently by a pool of threads, which
+    # pays off when each listing is a round-trip to network storage. The
+    # result is sorted afterwards, so the order does not depend on timing.
+    import queue
+    from concurrent.futures import ThreadPoolExecutor
+
+    entries = []
+    results = queue.Queue()
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        def submit(dirpath):
+            future = pool.submit(scan, dirpath)
+            future.add_done_callback(lambda f: results.put((dirpath, f)))
+
+        submit(root)
+        outstanding = 1
+        while outstanding:
+            dirpath, future = results.get()
+            outstanding -= 1
+            try:
+                names, subdirs, listed = future.result()
+            except OSError:
+                continue
+            path = intern_directory(os.path.join(dirpath, ""))
+            snapshot[path] = listed
+            entries.extend((path, name, is_dir) for name, is_dir in names)
+            for subdir in subdirs:
+                submit(subdir)
+                outstanding += 1
+    return entries
+
+
+def init_fn_buffer(config, dirs=None):
+    # Entries are keyed by their original name, paired with their directory
+    # when recursing, rather than by a newly built full path.
     fn_buffer = {}
-    files = get_file_listing(config)
+    files = get_file_listing(config, dirs)
     if config.recursive:
         for f in files:
-            fn_buffer[f.fullpath()] = f
+            fn_buffer[(f.path, f.orig)] = f
     else:
         for f in files:
-            fn_buffer[f.full()] = f
+            fn_buffer[f.orig] = f
     return fn_buffer
 
 
-def rename_file(config, old, new):
-    try:
-        if old == new:
-            return True
-        if new == "":
-            print("Warning: attempt to rename file to empty name: {}", old)
-            return False
-        if config.git_mode:
-            subprocess.run(["git", "mv", old, new], check=True)
-        else:
-            os.renames(old, new)
+def rename_file(config, old, new, git_mode=None):
+    if git_mode is None:
+        git_mode = config.git_mode
+    if old == new:
         return True
-    except CalledProcessError as e:
-        print("error while git renaming {} to {}",format(old, new))
-        print("error:", e)
+    if new == "":
+        print("Warning: attempt to rename file to empty name: {}", old)
         return False
+    if git_mode:
+        return git_move_file(config, old, new)
+    try:
+        os.renames(old, new)
+        return True
     except Exception as e:
-        print("error while renaming {} to {}".format(old, new))
-        print("error: ", e)
+        report("error while renaming {} to {}".format(old, new),
+               "error:  {}".format(e))
         return False
 
 
 def rename_files(config, fn_buffer):
-    for k, v in fn_buffer.items():
-        if (k != fn_buffer[k].full()) and os.path.exists(fn_buffer[k].full()):
-            t = fn_buffer[k].name + fn_buffer[k].ext
+    apply_renames(config, rename_pairs(config, fn_buffer))
+
+
+def apply_renames(config, renames):
+    # A target may exist if it is itself renamed away first.
+    sources = {old for old, new in renames}
+    for old, new in renames:
+        if (new not in sources) and target_exists(config, new):
             error_msg = "error while renaming {} to {}! -> {} already exists!"
-            sys.exit(error_msg.format(k, t, t))
-    for k, v in sorted(fn_buffer.items()):
-        rename_file(config, v.path + k, v.path + v.full())
+            sys.exit(error_msg.format(old, new, new))
+    renames, dependencies = plan_renames(renames)
+    if config.git_mode:
+        git_rename_files(config, renames, dependencies)
+    else:
+        execute_renames(config, renames, dependencies)
 
 
-def output_undo_script(fn_buffer):
-    f = open("undo.sh", "w")
-    for k, v in fn_buffer.items():
-        f.write('mv "{}" "{}"\n'.format(v.full(), k))
-    f.close()
+def target_exists(config, path):
+    # Answered from the names seen while listing; only paths in directories
+    # that were not scanned need a stat.
+    head, tail = os.path.split(path)
+    names = config.snapshot.get(os.path.join(head, ""))
+    if names is None:
+        return os.path.lexists(path)
+    return tail in names
 
 
-def verify_fn_buffer(fn_buffer):
-    for k1, v1 in fn_buffer.items():
-        for k2, v2 in fn_buffer.items():
-            if (k1 != k2) and (v1.fullpath() == v2.fullpath()):
-                print(ERRMSGS["duplicate"])
-                print(v1.full())
-                print(v2.full())
-                sys.exit("")
+def rename_pairs(config, fn_buffer):
+    renames = []
+    for k, v in sorted(fn_buffer.items()):
+        old = v.origpath()
+        new = v.fullpath()
+        if old != new:
+            renames.append((old, new))
+    return renames
+
+
+def output_undo_script(config, fn_buffer):
+    """ Write undo.sh, moving each file back with absolute paths.
+
+    The script can be run with sh, so the moves are in an order that never
+    overwrites a file, or replayed with --undo, which reads the renames back
+    and applies them like any other.
+    """
+    import shlex
+    undo = undo_renames(rename_pairs(config, fn_buffer))
+    renames, dependencies = plan_renames(undo)
+    with open("undo.sh", "w", errors="surrogateescape") as f:
+        f.write("#!/bin/sh\n{}\n".format(UNDO_HEADER))
+        for old, new in renames:
+            f.write("mv -- {} {}\n".format(shlex.quote(old), shlex.quote(new)))
+
+
+def undo_renames(renames):
+    """ Return the renames moving each entry back once renames are applied.
+
+    An entry ends up with its new name in the final location of its
+    directory, which may be renamed too, so it is moved back to its original
+    name there. The directory itself is moved back afterwards, as the planner
+    orders the renames of the entries inside a directory before its own.
+    """
+    moved = dict(renames)
+    final = {}
+
+    def final_path(path):
+        chain = []
+        top = path
+        while top not in final:
+            head, tail = os.path.split(top)
+            if head == top:
+                final[top] = top
+                break
+            chain.append(top)
+            top = head
+        for d in reversed(chain):
+            head, tail = os.path.split(d)
+            new = moved.get(d)
+            if new is not None:
+                tail = new[len(d) - len(tail):]
+            final[d] = os.path.join(final[head], tail)
+        return final[path]
+
+    undo = []
+    for old, new in renames:
+        head, tail = os.path.split(old)
+        parent = final_path(head)
+        undo.append((os.path.join(parent, new[len(old) - len(tail):]),
+                     os.path.join(parent, tail)))
+    return undo
+
+
+def read_undo_script(filename):
+    """ Return the renames of an undo script, merging the moves through
+    temporary names back into single renames.
+    """
+    try:
+        with open(filename, errors="surrogateescape") as f:
+            text = f.read()
+    except OSError as e:
+        sys.exit(e)
+    if UNDO_HEADER not in text.split("\n", 2)[:2]:
+        sys.exit(ERRMSGS["undo-invalid"].format(filename))
+
+    def unquote(token):
+        return "".join(a or b or c for a, b, c in
+                       UNDO_QUOTE_REGEX.findall(token))
+
+    renames = []
+    # In a planned order, a target is only renamed again when it is a
+    # temporary name.
+    hops = {}
+    pos = text.index(UNDO_HEADER) + len(UNDO_HEADER) + 1
+    while pos < len(text):
+        m = UNDO_RECORD_REGEX.match(text, pos)
+        if m is None:
+            m = UNDO_COMMENT_REGEX.match(text, pos)
+            if m is None:
+                sys.exit(ERRMSGS["undo-invalid"].format(filename))
+        else:
+            old, new = unquote(m.group(1)), unquote(m.group(2))
+            i = hops.pop(old, None)
+            if i is None:
+                hops[new] = len(renames)
+                renames.append((old, new))
+            else:
+                renames[i] = (renames[i][0], new)
+        pos = m.end()
+    return renames
+
+
+def replay_undo_script(config):
+    renames = read_undo_script(config.replay)
+    targets = set()
+    for old, new in renames:
+        if new in targets:
+            print(ERRMSGS["duplicate"])
+            print(new)
+            print(new)
+            sys.exit("")
+        targets.add(new)
+    if 1 <= config.verbosity <= 2:
+        print_renames(config, renames)
+        print()
+    if obtain_confirmation(config, None):
+        open_journal(config, config.journal_file)
+        with stage(config, "rename"):
+            apply_renames(config, renames)
+        close_journal(config)
+
+
+def verify_fn_buffer(fn_buffer, index=None):
+    if index is None:
+        index = CollisionIndex()
+    index.sync(fn_buffer)
+    name = index.first_duplicate()
+    if name is not None:
+        exit_duplicate(name)
+
+
+def exit_duplicate(name):
+    # Both entries share the same target, so they print the same name.
+    print(ERRMSGS["duplicate"])
+    print(name)
+    print(name)
+    sys.exit("")
 
 
 def clean_fn_buffer(fn_buffer):
     new_fn_buffer = fn_buffer.copy()
     for k, v in fn_buffer.items():
-        if (k == v.full()):
+        if (v.orig == v.full()):
             del new_fn_buffer[k]
     return new_fn_buffer
 
 
+def plan_renames(renames):
+    """ Plan the renames so that every target is vacated before it is reused.
+
+    Cycles such as swaps are broken with one hop through a temporary name and
+    the renames are put in topological order. Returns the ordered renames and
+    their dependencies, as indexes into the ordered list. Runs in linear time.
+    """
+    renames, hops = break_rename_cycles(renames)
+    dependencies = rename_dependencies(renames, hops)
+    order = topological_order(dependencies)
+    position = [0] * len(order)
+    for p, i in enumerate(order):
+        position[i] = p
+    renames = [renames[i] for i in order]
+    dependencies = [[position[j] for j in dependencies[i]] for i in order]
+    return renames, dependencies
+
+
+def break_rename_cycles(renames):
+    # Each target is the source of at most one other rename, so following
+    # targets from any rename walks a chain that either ends or loops back.
+    # Returns the new renames and the (first, second) indexes of each hop.
+    sources = {old: i for i, (old, new) in enumerate(renames)}
+    result = list(renames)
+    hops = []
+    state = [0] * len(renames)  # 0: unvisited, 1: on current walk, 2: done
+    for start in range(len(renames)):
+        walk = []
+        i = start
+        while (i is not None) and (state[i] == 0):
+            state[i] = 1
+            walk.append(i)
+            i = sources.get(renames[i][1])
+        if (i is not None) and (state[i] == 1):
+            old, new = renames[i]
+            tmp = temporary_path(old)
+            result[i] = (old, tmp)
+            result.append((tmp, new))
+            hops.append((i, len(result) - 1))
+        for j in walk:
+            state[j] = 2
+    return result, hops
+
+
+def temporary_path(path):
+    head, tail = os.path.split(path)
+    n = 0
+    while True:
+        tmp = os.path.join(head, ".{}.{}-{}.np".format(tail, os.getpid(), n))
+        if not os.path.lexists(tmp):
+            return tmp
+        n += 1
+
+
+def topological_order(dependencies):
+    waiting = [len(deps) for deps in dependencies]
+    dependents = rename_dependents(dependencies)
+    ready = collections.deque(i for i, n in enumerate(waiting) if n == 0)
+    order = []
+    while ready:
+        i = ready.popleft()
+        order.append(i)
+        for j in dependents[i]:
+            waiting[j] -= 1
+            if waiting[j] == 0:
+                ready.append(j)
+    return order
+
+
+def rename_dependents(dependencies):
+    dependents = [[] for deps in dependencies]
+    for i, deps in enumerate(dependencies):
+        for j in deps:
+            dependents[j].append(i)
+    return dependents
+
+
+def rename_dependencies(renames, hops=()):
+    """ For each rename, return the indexes of the renames that must complete
+    before it: the one moving away the file at its target, those of entries
+    inside the directory it renames, the one giving its name to the directory
+    its source is in, as when an undo script restores a directory and then
+    its contents, and, for the second half of a hop through a temporary name,
+    the first half.
+    """
+    seconds = {second for first, second in hops}
+    sources = {old: i for i, (old, new) in enumerate(renames)
+               if i not in seconds}
+    targets = {new: i for i, (old, new) in enumerate(renames)}
+    dependencies = [[] for r in renames]
+    for first, second in hops:
+        dependencies[second].append(first)
+    for i, (old, new) in enumerate(renames):
+        j = sources.get(new)
+        if (j is not None) and (j != i):
+            dependencies[i].append(j)
+        # The nearest directory above the source that is renamed, away or
+        # into place.
+        parent = os.path.dirname(old)
+        while True:
+            if parent in sources:
+                dependencies[sources[parent]].append(i)
+                break
+            if (parent in targets) and (targets[parent] != i):
+                dependencies[i].append(targets[parent])
+                break
+            up = os.path.dirname(parent)
+            if up == parent:
+                break
+            parent = up
+    return dependencies
+
+
+def execute_renames(config, renames, dependencies=None, ids=None):
+    """ Apply (old, new) renames in order, or on a pool of config.jobs threads.
+
+    A rename starts only after the renames it depends on have completed, and
+    is skipped if one of them failed, so that no file is overwritten. With a
+    journal, ids are the numbers of the renames in it, and they are planned
+    in it first if not given.
+    """
+    if dependencies is None:
+        dependencies = rename_dependencies(renames)
+    journal = config.journal
+    if (journal is not None) and (ids is None):
+        ids = journal.plan(renames, dependencies)
+    record = stage(config, "rename")
+    waiting = [len(deps) for deps in dependencies]
+    dependents = rename_dependents(dependencies)
+    blocked = [False] * len(renames)
+    finished = [False] * len(renames)
+    ready = collections.deque(i for i, n in enumerate(waiting) if n == 0)
+
+    def finish(i, ok):
+        pending = [(i, ok)]
+        while pending:
+            i, ok = pending.pop()
+            finished[i] = True
+            if journal is not None:
+                journal.record(ids[i], ok)
+            record.entries += 1
+            record.changed += ok
+            for j in dependents[i]:
+                blocked[j] = blocked[j] or not ok
+                waiting[j] -= 1
+                if waiting[j] > 0:
+                    continue
+                if blocked[j]:
+                    report("skipping {}: a rename it depends on failed".format(
+                        renames[j][0]))
+                    pending.append((j, False))
+                else:
+                    ready.append(j)
+
+    if config.jobs > 1:
+        execute_renames_parallel(config, renames, ready, finish)
+    else:
+        while ready:
+            i = ready.popleft()
+            finish(i, rename_file(config, *renames[i]))
+
+    for i, done in enumerate(finished):
+        if not done:
+            report("error while renaming {} to {}".format(*renames[i]),
+                   "error: circular dependency between renames")
+    if journal is not None:
+        journal.sync()
+
+
+def execute_renames_parallel(config, renames, ready, finish):
+    import queue
+    from concurrent.futures import ThreadPoolExecutor
+
+    results = queue.Queue()
+    with ThreadPoolExecutor(max_workers=config.jobs) as pool:
+        def submit(i):
+            future = pool.submit(rename_file, config, *renames[i])
+            future.add_done_callback(lambda f: results.put((i, f.result())))
+
+        outstanding = 0
+        while ready or outstanding:
+            while ready:
+                submit(ready.popleft())
+                outstanding += 1
+            i, ok = results.get()
+            outstanding -= 1
+            finish(i, ok)
+
+
+###############################################################################
+# DIRECTORY INDEX
+#
+# The listing of each directory scanned, kept in an sqlite database between
+# runs. A directory is listed again only when its mtime, inode or device
+# changed, which is the case whenever an entry is added, removed or renamed
+# in it; other directories are read from the index after a single stat.
+
+
+# Directories modified this recently are not stored: a change in the same
+# mtime tick as the listing would go unnoticed on the next run.
+INDEX_RACY_SECONDS = 2
+INDEX_FILE = 0
+INDEX_DIR = 1
+INDEX_DIR_LINK = 2
+
+
+class DirectoryIndex:
+
+    def __init__(self, filename):
+        import sqlite3
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY "
+                        "KEY, mtime INTEGER, ino INTEGER, dev INTEGER, "
+                        "names BLOB, kinds BLOB) WITHOUT ROWID")
+        # Scans run on several threads with -j.
+        self.lock = threading.Lock()
+        self.seen = set()
+
+    def lookup(self, dirpath, st):
+        """ Return the (name, kind) entries indexed for dirpath, or None if
+        the directory changed since.
+        """
+        with self.lock:
+            self.seen.add(dirpath)
+            row = self.db.execute("SELECT mtime, ino, dev, names, kinds FROM "
+                                  "dirs WHERE path = ?", (dirpath,)).fetchone()
+        if row is None or row[:3] != (st.st_mtime_ns, st.st_ino, st.st_dev):
+            return None
+        if not row[3]:
+            return []
+        names = [os.fsdecode(name) for name in row[3].split(b"\0")]
+        return list(zip(names, row[4]))
+
+    def store(self, dirpath, st, entries):
+        if time.time() - st.st_mtime < INDEX_RACY_SECONDS:
+            return
+        names = b"\0".join(os.fsencode(name) for name, kind in entries)
+        kinds = bytes(kind for name, kind in entries)
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO dirs VALUES "
+                            "(?, ?, ?, ?, ?, ?)",
+                            (dirpath, st.st_mtime_ns, st.st_ino, st.st_dev,
+                             names, kinds))
+
+    def close(self, root=None):
+        """ Commit the index. If a tree was walked from root, directories
+        under it that were not seen no longer exist and are dropped.
+        """
+        if root is not None:
+            prefix = os.path.join(root, "")
+            stale = [(path,) for path, in self.db.execute(
+                "SELECT path FROM dirs WHERE substr(path, 1, ?) = ?",
+                (len(prefix), prefix)) if path not in self.seen]
+            self.db.executemany("DELETE FROM dirs WHERE path = ?", stale)
+        self.db.commit()
+        self.db.close()
+
+
+def scan_indexed_directory(dirpath, match, file_mode, index):
+    """ Same as scan_directory, taking the entries from the index when the
+    directory has not changed since it was indexed.
+    """
+    # The stat comes first, so that a change made during the listing leaves
+    # the stored mtime behind.
+    st = os.stat(dirpath)
+    entries = index.lookup(dirpath, st)
+    if entries is None:
+        entries = list_directory(dirpath)
+        index.store(dirpath, st, entries)
+    names = []
+    subdirs = []
+    listed = set()
+    for name, kind in entries:
+        listed.add(name)
+        if kind == INDEX_DIR:
+            subdirs.append(os.path.join(dirpath, name))
+        if (match is not None) and not match(name):
+            continue
+        is_dir = kind != INDEX_FILE
+        if not ((file_mode == 'b') or ((file_mode == 'd') == is_dir)):
+            continue
+        names.append((name, is_dir))
+    return names, subdirs, listed
+
+
+def list_directory(dirpath):
+    entries = []
+    with os.scandir(dirpath) as it:
+        for entry in it:
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            if not is_dir:
+                kind = INDEX_FILE
+            elif entry.is_symlink():
+                kind = INDEX_DIR_LINK
+            else:
+                kind = INDEX_DIR
+            entries.append((entry.name, kind))
+    return entries
+
+
+###############################################################################
+# STREAMING
+#
+# For directories too large to hold in memory: each directory is scanned in
+# chunks of STREAM_CHUNK entries, the planned renames are written to a
+# temporary file, and the names used to detect collisions are kept in sets
+# that move to a temporary database past SPILL_LIMIT items.
+
+
+STREAM_CHUNK = 10000
+SPILL_LIMIT = 1000000
+
+
+class SpillSet:
+    """ A set of strings that moves to an on-disk database when it grows
+    past a limit.
+    """
+
+    def __init__(self, limit=SPILL_LIMIT):
+        self.limit = limit
+        self.items = set()
+        self.db = None
+        self.tmpdir = None
+
+    def add(self, item):
+        """ Add item, returning False if it was already present. """
+        if self.db is not None:
+            c = self.db.execute("INSERT OR IGNORE INTO s VALUES (?)", (item,))
+            return c.rowcount == 1
+        if item in self.items:
+            return False
+        self.items.add(item)
+        if len(self.items) > self.limit:
+            self.spill()
+        return True
+
+    def __contains__(self, item):
+        if self.db is not None:
+            c = self.db.execute("SELECT 1 FROM s WHERE k = ?", (item,))
+            return c.fetchone() is not None
+        return item in self.items
+
+    def spill(self):
+        import sqlite3
+        import tempfile
+        self.tmpdir = tempfile.mkdtemp(prefix="name_pryer.")
+        self.db = sqlite3.connect(os.path.join(self.tmpdir, "spill.db"))
+        self.db.execute("PRAGMA journal_mode = OFF")
+        self.db.execute("PRAGMA synchronous = OFF")
+        self.db.execute("CREATE TABLE s (k TEXT PRIMARY KEY) WITHOUT ROWID")
+        self.db.executemany("INSERT INTO s VALUES (?)",
+                            ((item,) for item in self.items))
+        self.items = set()
+
+    def close(self):
+        if self.db is not None:
+            import shutil
+            self.db.close()
+            self.db = None
+            shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+
+def check_streamable(config, actions):
+    if config.git_mode:
+        sys.exit(ERRMSGS["stream-unsupported"].format("--git"))
+    if config.undo:
+        sys.exit(ERRMSGS["stream-unsupported"].format("-u"))
+    if config.index_file is not None:
+        sys.exit(ERRMSGS["stream-unsupported"].format("--index"))
+    if config.manifest is not None:
+        sys.exit(ERRMSGS["stream-unsupported"].format("--manifest"))
+    if split_glob(config.pattern)[0]:
+        sys.exit(ERRMSGS["stream-unsupported"].format("-g with a directory"))
+    if per_action_output(actions):
+        sys.exit(ERRMSGS["stream-unsupported"].format("-v 3"))
+    for action in actions:
+        if action.name == "pattern":
+            if PatternMatcher(action.arg1, action.arg2).uses_counter():
+                sys.exit(ERRMSGS["stream-unsupported"].format("{num}"))
+
+
+def handle_actions_streaming(config, actions):
+    """ Apply the actions to the entries as they are listed, one directory at
+    a time, and return the plan: a temporary file with the renames, and the
+    offset at which the renames of each directory start.
+    """
+    import tempfile
+    if uses_file_dates(actions):
+        config.file_times = {}
+    steps = compile_actions(config, actions)
+    match = compile_glob(config.pattern)
+    plan = tempfile.TemporaryFile()
+    offsets = []
+    pending = [os.path.abspath(config.directory)]
+    while pending:
+        dirpath = pending.pop()
+        offsets.append(plan.tell())
+        try:
+            subdirs = stream_directory(config, dirpath, match, steps, plan)
+        except OSError:
+            if not offsets[1:]:
+                raise
+            continue
+        if config.recursive:
+            pending.extend(subdirs)
+    return plan, offsets
+
+
+def stream_directory(config, dirpath, match, steps, plan):
+    path = intern_directory(os.path.join(dirpath, ""))
+    start = plan.tell()
+    names = SpillSet()
+    targets = SpillSet()
+    exts = {}
+    subdirs = []
+    chunk = []
+    try:
+        with os.scandir(dirpath) as it:
+            for entry in it:
+                names.add(entry.name)
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                if is_dir and not entry.is_symlink():
+                    subdirs.append(entry.path)
+                if (match is not None) and not match(entry.name):
+                    continue
+                if not ((config.file_mode == 'b') or
+                        ((config.file_mode == 'd') == is_dir)):
+                    continue
+                if config.file_times is not None:
+                    try:
+                        config.file_times[entry.path] = entry_times(entry)
+                    except OSError:
+                        continue
+                f = make_file(path, entry.name, is_dir, exts)
+                key = (path, f.orig) if config.recursive else f.orig
+                kept = all(step(key, f) for step in steps)
+                if config.file_times is not None:
+                    del config.file_times[entry.path]
+                if config.plan is not None:
+                    if kept:
+                        config.plan.entry(key, f)
+                    else:
+                        config.plan.discard(key)
+                if not kept:
+                    continue
+                new = f.full()
+                if new == f.orig:
+                    continue
+                if not targets.add(new):
+                    print(ERRMSGS["duplicate"])
+                    print(new)
+                    print(new)
+                    sys.exit("")
+                chunk.append((f.orig, new))
+                if len(chunk) >= STREAM_CHUNK:
+                    write_plan_chunk(config, path, chunk, plan)
+                    chunk = []
+        write_plan_chunk(config, path, chunk, plan)
+
+        # Only now are all the names in the directory known.
+        end = plan.tell()
+        plan.seek(start)
+        for old, new in read_plan(plan, end):
+            if os.path.basename(new) in names:
+                error_msg = ("error while renaming {} to {}! -> {} already "
+                             "exists!")
+                sys.exit(error_msg.format(old, new, new))
+        plan.seek(end)
+    finally:
+        names.close()
+        targets.close()
+    return subdirs
+
+
+def write_plan_chunk(config, path, chunk, plan):
+    if not chunk:
+        return
+    if 1 <= config.verbosity <= 2:
+        if config.recursive:
+            print_renames(config, [(path + old, path + new)
+                                   for old, new in chunk])
+        else:
+            print_renames(config, chunk)
+    records = []
+    for old, new in chunk:
+        records.append(os.fsencode(path + old))
+        records.append(os.fsencode(path + new))
+    plan.write(b"\0".join(records) + b"\0")
+
+
+def read_plan(plan, end):
+    # Yields the (old, new) records from the current position up to end,
+    # reading the file in blocks.
+    pending = b""
+    pair = []
+    while plan.tell() < end:
+        block = plan.read(min(1 << 20, end - plan.tell()))
+        if not block:
+            break
+        fields = (pending + block).split(b"\0")
+        pending = fields.pop()
+        for field in fields:
+            pair.append(os.fsdecode(field))
+            if len(pair) == 2:
+                yield tuple(pair)
+                pair = []
+
+
+def rename_streamed(config, plan):
+    # Directories were planned parents first, so they are renamed in reverse
+    # order and the entries inside a directory are moved before it is.
+    plan, offsets = plan
+    ends = offsets[1:] + [plan.seek(0, os.SEEK_END)]
+    segments = list(reversed(list(zip(offsets, ends))))
+    # The whole plan goes to the journal before the first rename, so that
+    # the run can be resumed from any point.
+    planned = []
+    if config.journal is not None:
+        for chunk in streamed_chunks(plan, segments):
+            planned.append(config.journal.plan(chunk,
+                                               rename_dependencies(chunk)))
+    for n, chunk in enumerate(streamed_chunks(plan, segments)):
+        execute_renames(config, chunk, ids=planned[n] if planned else None)
+    plan.close()
+
+
+def streamed_chunks(plan, segments):
+    for start, end in segments:
+        plan.seek(start)
+        chunk = []
+        for rename in read_plan(plan, end):
+            chunk.append(rename)
+            if len(chunk) >= STREAM_CHUNK:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+
+###############################################################################
+# JOURNAL
+#
+# An append-only record of a run, one JSON list per line: the planned
+# renames with their dependencies, written and synced before the first
+# rename, then the outcome of each rename, synced in batches. Completions lost
+# in a crash are recognized on resume from the state of the file system.
+
+
+JOURNAL_VERSION = 1
+JOURNAL_BATCH = 1000
+JOURNAL_INTERVAL = 1.0
+
+
+class Journal:
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = open(filename, "a", encoding="utf-8",
+                         errors="surrogateescape")
+        self.count = 0
+        self.unsynced = 0
+        self.synced_at = time.monotonic()
+        if self.file.tell() == 0:
+            self.write(["journal", JOURNAL_VERSION])
+        else:
+            self.count = len(read_journal(filename)[0])
+
+    def write(self, record):
+        import json
+        self.file.write(json.dumps(record) + "\n")
+
+    def plan(self, renames, dependencies):
+        """ Record the renames, returning their numbers in the journal. """
+        base = self.count
+        for i, (old, new) in enumerate(renames):
+            deps = [base + j for j in dependencies[i]]
+            self.write(["plan", base + i, old, new, deps])
+        self.count += len(renames)
+        self.sync()
+        return range(base, self.count)
+
+    def record(self, i, ok):
+        self.write(["done" if ok else "failed", i])
+        self.unsynced += 1
+        if ((self.unsynced >= JOURNAL_BATCH) or
+                (time.monotonic() - self.synced_at >= JOURNAL_INTERVAL)):
+            self.sync()
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.unsynced = 0
+        self.synced_at = time.monotonic()
+
+    def close(self):
+        self.sync()
+        self.file.close()
+
+
+def open_journal(config, filename):
+    if filename is not None:
+        try:
+            config.journal = Journal(filename)
+        except OSError as e:
+            sys.exit(e)
+
+
+def close_journal(config):
+    if config.journal is not None:
+        config.journal.close()
+        config.journal = None
+
+
+def read_journal(filename):
+    """ Return the planned renames, their dependencies and the numbers of
+    those recorded as done.
+    """
+    import json
+    renames = []
+    dependencies = []
+    done = set()
+    header = None
+    try:
+        f = open(filename, encoding="utf-8", errors="surrogateescape")
+    except OSError as e:
+        sys.exit(e)
+    with f:
+        for n, line in enumerate(f):
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # A line cut short by a crash ends the journal.
+                break
+            if header is None:
+                header = record
+            elif record[0] == "plan":
+                renames.append((record[2], record[3]))
+                dependencies.append(record[4])
+            elif record[0] == "done":
+                done.add(record[1])
+    if header != ["journal", JOURNAL_VERSION]:
+        sys.exit(ERRMSGS["resume-invalid"].format(filename))
+    return renames, dependencies, done
+
+
+def resume_renames(config):
+    """ Apply the renames of a journal that have not completed yet. """
+    renames, dependencies, done = read_journal(config.resume)
+    # Renames that completed but whose outcome was not synced. A rename only
+    # starts once those it depends on have completed, so going from the end
+    # of each chain, a rename is done if one depending on it is. Otherwise
+    # it is done if its source is gone: nothing else could have moved it.
+    dependents = rename_dependents(dependencies)
+    for i in reversed(range(len(renames))):
+        if i in done:
+            continue
+        old, new = renames[i]
+        if (any(j in done for j in dependents[i]) or
+                (not os.path.lexists(old) and os.path.lexists(new))):
+            done.add(i)
+    # A target that exists must be vacated by a rename that is still to be
+    # made, which comes first in the plan, or it would be overwritten.
+    sources = {}
+    refused = set()
+    ids = []
+    for i, (old, new) in enumerate(renames):
+        if i in done:
+            continue
+        if any(j in refused for j in dependencies[i]):
+            report("skipping {}: a rename it depends on failed".format(old))
+            refused.add(i)
+            continue
+        if os.path.lexists(new) and (new not in sources):
+            report("error while renaming {} to {}! -> {} already "
+                   "exists!".format(old, new, new))
+            refused.add(i)
+            continue
+        sources[old] = i
+        ids.append(i)
+    if not ids:
+        print("nothing left to rename in {}".format(config.resume))
+        return
+
+    position = {i: p for p, i in enumerate(ids)}
+    pending = [renames[i] for i in ids]
+    pending_dependencies = [[position[j] for j in dependencies[i]
+                             if j in position] for i in ids]
+    if 1 <= config.verbosity <= 2:
+        print_renames(config, pending)
+        print()
+    if obtain_confirmation(config, None):
+        open_journal(config, config.resume)
+        with stage(config, "rename"):
+            execute_renames(config, pending, pending_dependencies, ids)
+        close_journal(config)
+
+
+###############################################################################
+# WATCH
+#
+# A long running mode for ingest directories: the actions are compiled once,
+# and only the entries created in or moved into the watched directories are
+# run through them, checked for collisions and renamed as they arrive. On
+# Linux the arrivals are read from inotify; elsewhere, or with --poll, the
+# directories whose mtime changed are listed again at an interval.
+
+
+WATCH_POLL_INTERVAL = 1.0
+WATCH_READ_SIZE = 1 << 16
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+              IN_DELETE | IN_ONLYDIR)
+
+
+class InotifyWatcher:
+    """ Reports the entries created in or moved into a set of directories,
+    through the Linux inotify interface.
+
+    A created file is only reported once it is closed after writing, so that
+    it is not renamed while it is still being written, and the renames made
+    by the watch itself, announced with moved(), are not reported.
+    """
+
+    def __init__(self, recursive):
+        import ctypes
+        import ctypes.util
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"),
+                                use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self.recursive = recursive
+        # watch descriptor of each watched directory and back
+        self.paths = {}
+        self.wds = {}
+        self.created = set()
+        self.own = set()
+
+    def add(self, dirpath):
+        """ Watch dirpath, and its subdirectories when recursive. Returns the
+        (dirpath, name) entries found in them.
+        """
+        import ctypes
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(dirpath),
+                                         WATCH_MASK)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), dirpath)
+        # Listed after the watch is in place, so that nothing is missed.
+        path = intern_directory(os.path.join(dirpath, ""))
+        self.paths[wd] = path
+        self.wds[path] = wd
+        entries = []
+        for name, kind in list_directory(dirpath):
+            entries.append((path, name))
+            if self.recursive and (kind == INDEX_DIR):
+                try:
+                    entries.extend(self.add(path + name))
+                except OSError:
+                    continue
+        return entries
+
+    def wait(self):
+        """ Block until entries arrive, and return them. """
+        arrivals = []
+        while not arrivals:
+            moved = {}
+            for event in read_inotify_events(os.read(self.fd,
+                                                     WATCH_READ_SIZE)):
+                arrivals.extend(self.event(moved, *event))
+            # Directories moved out of the tree.
+            for path in moved.values():
+                self.forget(path)
+        return arrivals
+
+    def event(self, moved, wd, mask, cookie, name):
+        if mask & IN_Q_OVERFLOW:
+            report("warning: too many events, some entries were not renamed")
+            return []
+        path = self.paths.get(wd)
+        if path is None:
+            return []
+        if mask & IN_IGNORED:
+            self.forget(path)
+            return []
+        entry = path + name
+        if mask & (IN_MOVED_FROM | IN_DELETE):
+            self.created.discard(entry)
+            if (mask & IN_MOVED_FROM) and (os.path.join(entry, "") in
+                                           self.wds):
+                moved[cookie] = os.path.join(entry, "")
+            return []
+        if (mask & IN_CREATE) and not (mask & IN_ISDIR):
+            self.created.add(entry)
+            return []
+        if mask & IN_CLOSE_WRITE:
+            if entry not in self.created:
+                return []
+            self.created.discard(entry)
+            return [(path, name)]
+
+        arrivals = []
+        if (mask & IN_MOVED_TO) and (cookie in moved):
+            # Moved within the tree: its subdirectories are still watched.
+            self.relocate(moved.pop(cookie), os.path.join(entry, ""))
+        elif self.recursive and (mask & IN_ISDIR):
+            try:
+                arrivals = self.add(entry)
+            except OSError:
+                pass
+        if entry in self.own:
+            self.own.discard(entry)
+            return arrivals
+        return [(path, name)] + arrivals
+
+    def moved(self, path, old, new):
+        self.own.add(path + new)
+
+    def relocate(self, old, new):
+        for path in [p for p in self.wds if p.startswith(old)]:
+            wd = self.wds.pop(path)
+            path = intern_directory(new + path[len(old):])
+            self.wds[path] = wd
+            self.paths[wd] = path
+
+    def forget(self, old):
+        for path in [p for p in self.wds if p.startswith(old)]:
+            wd = self.wds.pop(path)
+            del self.paths[wd]
+            self.libc.inotify_rm_watch(self.fd, wd)
+
+    def close(self):
+        os.close(self.fd)
+
+
+def read_inotify_events(buf):
+    # struct inotify_event: int wd, uint32 mask, cookie and len, and len
+    # bytes of NUL padded name.
+    import struct
+    pos = 0
+    while pos < len(buf):
+        wd, mask, cookie, size = struct.unpack_from("iIII", buf, pos)
+        pos += 16
+        name = os.fsdecode(buf[pos:pos + size].rstrip(b"\0"))
+        pos += size
+        yield wd, mask, cookie, name
+
+
+class PollingWatcher:
+    """ Reports the entries that appeared in a set of directories, listing
+    again every interval seconds the directories whose mtime changed.
+
+    Unlike with inotify, a directory moved within the tree is taken for a
+    new one, and a file may be reported while it is still being written.
+    """
+
+    def __init__(self, recursive, interval):
+        self.recursive = recursive
+        self.interval = interval
+        # (mtime, inode) and names of each watched directory
+        self.dirs = {}
+
+    def add(self, dirpath):
+        path = intern_directory(os.path.join(dirpath, ""))
+        st = os.stat(dirpath)
+        entries = list_directory(dirpath)
+        self.dirs[path] = ((st.st_mtime_ns, st.st_ino),
+                           {name for name, kind in entries})
+        found = []
+        for name, kind in entries:
+            found.append((path, name))
+            if self.recursive and (kind == INDEX_DIR):
+                try:
+                    found.extend(self.add(path + name))
+                except OSError:
+                    continue
+        return found
+
+    def wait(self):
+        while True:
+            time.sleep(self.interval)
+            arrivals = self.poll()
+            if arrivals:
+                return arrivals
+
+    def poll(self):
+        arrivals = []
+        for path in list(self.dirs):
+            if path not in self.dirs:
+                continue
+            signature, names = self.dirs[path]
+            try:
+                st = os.stat(path)
+                if (st.st_mtime_ns, st.st_ino) == signature:
+                    continue
+                entries = list_directory(path)
+            except OSError:
+                self.forget(path)
+                continue
+            listed = {name for name, kind in entries}
+            self.dirs[path] = ((st.st_mtime_ns, st.st_ino), listed)
+            for name in names - listed:
+                self.forget(os.path.join(path + name, ""))
+            for name, kind in entries:
+                if name in names:
+                    continue
+                arrivals.append((path, name))
+                if self.recursive and (kind == INDEX_DIR):
+                    try:
+                        arrivals.extend(self.add(path + name))
+                    except OSError:
+                        continue
+        return arrivals
+
+    def moved(self, path, old, new):
+        names = self.dirs[path][1]
+        names.discard(old)
+        names.add(new)
+        old = os.path.join(path + old, "")
+        new = os.path.join(path + new, "")
+        for dirpath in [p for p in self.dirs if p.startswith(old)]:
+            self.dirs[intern_directory(new + dirpath[len(old):])] = \
+                self.dirs.pop(dirpath)
+
+    def forget(self, old):
+        for path in [p for p in self.dirs if p.startswith(old)]:
+            del self.dirs[path]
+
+    def close(self):
+        pass
+
+
+def make_watcher(config):
+    if config.poll is None:
+        try:
+            return InotifyWatcher(config.recursive)
+        except (AttributeError, OSError):
+            # No inotify on this platform, or no instances left.
+            pass
+    interval = config.poll if config.poll is not None else WATCH_POLL_INTERVAL
+    return PollingWatcher(config.recursive, interval)
+
+
+def check_watchable(config, actions):
+    if config.stream:
+        sys.exit(ERRMSGS["watch-unsupported"].format("--stream"))
+    if config.undo:
+        sys.exit(ERRMSGS["watch-unsupported"].format("-u"))
+    if config.manifest is not None:
+        sys.exit(ERRMSGS["watch-unsupported"].format("--manifest"))
+    if per_action_output(actions):
+        sys.exit(ERRMSGS["watch-unsupported"].format("-v 3"))
+    if any(action.name == "tokenize" for action in actions):
+        sys.exit(ERRMSGS["watch-unsupported"].format("-t"))
+    if split_glob(config.pattern)[0]:
+        sys.exit(ERRMSGS["watch-unsupported"].format("-g with a directory"))
+
+
+def watch(config, actions):
+    """ Rename the entries arriving in the directory, or in the tree with
+    -R, until interrupted. The entries already there are left as they are.
+    """
+    steps = compile_actions(config, actions)
+    match = compile_glob(config.pattern)
+    watcher = make_watcher(config)
+    exts = {}
+    try:
+        watcher.add(os.path.abspath(config.directory))
+        while True:
+            arrivals = watcher.wait()
+            with stage(config, "watch") as record:
+                renames = watch_renames(config, arrivals, match, steps, exts)
+                record.entries += len(arrivals)
+            if not renames:
+                continue
+            if 1 <= config.verbosity <= 2:
+                print_renames(config, renames)
+                sys.stdout.flush()
+            # Entries inside a new directory are announced before it.
+            for old, new in reversed(renames):
+                path, name = os.path.split(old)
+                watcher.moved(os.path.join(path, ""), name,
+                              os.path.basename(new))
+            with stage(config, "rename"):
+                apply_renames(config, renames)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+
+
+def watch_renames(config, arrivals, match, steps, exts):
+    # Collisions are checked against the file system, and between the
+    # entries arriving together, whose targets may be each other's names.
+    renames = []
+    for path, name in dict.fromkeys(arrivals):
+        if (match is not None) and not match(name):
+            continue
+        old = path + name
+        if not os.path.lexists(old):
+            continue
+        is_dir = os.path.isdir(old)
+        if not ((config.file_mode == 'b') or
+                ((config.file_mode == 'd') == is_dir)):
+            continue
+        f = make_file(path, name, is_dir, exts)
+        key = (path, name) if config.recursive else name
+        if not all(step(key, f) for step in steps):
+            continue
+        if f.full() != name:
+            renames.append((old, path + f.full()))
+
+    # Skipping a rename keeps its source in place, which may in turn block
+    # the rename onto it.
+    kept = None
+    while kept != renames:
+        if kept is not None:
+            renames = kept
+        sources = {old for old, new in renames}
+        targets = set()
+        kept = []
+        for old, new in renames:
+            if new in targets:
+                report(ERRMSGS["duplicate"], old + " => " + new)
+            elif (new not in sources) and target_exists(config, new):
+                report("error while renaming {} to {}! -> {} already "
+                       "exists!".format(old, new, new))
+            else:
+                targets.add(new)
+                kept.append((old, new))
+    return kept
+
+
+###############################################################################
+# MANIFEST
+#
+# Several jobs in one run: each line of a manifest holds the -g and -M
+# filters and the actions of one job, as they would be given on the command
+# line. The directory is listed once, the jobs are applied in order to the
+# entries they select, as if they were separate runs, and the renames of all
+# the jobs are checked and applied together.
+
+
+class Job:
+    def __init__(self, pattern, file_mode, actions):
+        self.pattern = pattern
+        self.file_mode = file_mode
+        self.actions = actions
+
+
+def read_manifest(filename):
+    """ Return the jobs of a manifest. Blank lines and comments starting with
+    # are skipped.
+    """
+    import shlex
+    defaults = vars(Config())
+    jobs = []
+    with open(filename, encoding="utf-8", errors="surrogateescape") as f:
+        for n, line in enumerate(f, 1):
+            try:
+                argv = shlex.split(line, comments=True)
+            except ValueError as e:
+                sys.exit(ERRMSGS["manifest-invalid"].format(filename, n, e))
+            if not argv:
+                continue
+            config, actions = parse_args(["name_pryer"] + argv)
+            for key, value in vars(config).items():
+                if key in ("pattern", "file_mode", "now"):
+                    continue
+                if value != defaults[key]:
+                    sys.exit(ERRMSGS["manifest-option"].format(filename, n))
+            jobs.append(Job(config.pattern, config.file_mode, actions))
+    return jobs
+
+
+def handle_jobs(config, jobs):
+    # Every entry is listed, and each job picks its own from the names left
+    # by the jobs before it. An entry goes through a job on a copy, so that
+    # one dropped by the job's actions keeps its name.
+    if any(uses_file_dates(job.actions) for job in jobs):
+        config.file_times = {}
+    dirs = set()
+    with stage(config, "listing") as record:
+        fn_buffer = init_fn_buffer(config, dirs)
+        record.entries += len(fn_buffer)
+    for job in jobs:
+        match = compile_glob(job.pattern)
+        selected = {}
+        for k, v in fn_buffer.items():
+            is_dir = v in dirs
+            if not ((job.file_mode == 'b') or
+                    ((job.file_mode == 'd') == is_dir)):
+                continue
+            if (match is not None) and not match(v.full()):
+                continue
+            selected[k] = File(v.path, v.name, v.ext, v.orig)
+        if config.plan is not None:
+            traced = {k: len(config.plan.trace.get(k, ())) for k in selected}
+        kept = apply_actions(config, job.actions, selected)
+        for k, v in kept.items():
+            fn_buffer[k].set_name(v.name)
+            fn_buffer[k].set_ext(v.ext)
+        if config.plan is not None:
+            # Nor is it renamed by the actions it went through.
+            for k, n in traced.items():
+                if (k not in kept) and (k in config.plan.trace):
+                    del config.plan.trace[k][n:]
+    # Jobs only checked the entries they selected.
+    with stage(config, "verify") as record:
+        verify_fn_buffer(fn_buffer)
+        record.entries += len(fn_buffer)
+    if config.plan is not None:
+        for k, v in fn_buffer.items():
+            config.plan.entry(k, v)
+    return clean_fn_buffer(fn_buffer)
+
+
+###############################################################################
+# STATISTICS
+#
+# Opt-in instrumentation for --stats: wall time, entries processed and
+# changed, and file system calls for each stage of a run. File system calls
+# are counted by wrapping the os functions for the duration of the run, so
+# the code being measured is unchanged when statistics are off.
+
+
+FS_FUNCTIONS = ("scandir", "listdir", "stat", "lstat", "rename", "replace",
+                "mkdir", "rmdir", "unlink")
+
+
+class Stage:
+
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+        self.seconds = 0.0
+        self.entries = 0
+        self.changed = 0
+        self.fs_calls = 0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        if self.stats is not None:
+            self.start_fs_calls = self.stats.fs_calls
+        return self
+
+    def __exit__(self, *exc):
+        self.seconds += time.perf_counter() - self.start
+        if self.stats is not None:
+            self.fs_calls += self.stats.fs_calls - self.start_fs_calls
+        return False
+
+
+class Stats:
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.fs_calls = 0
+        self.lock = threading.Lock()
+        self.wrapped = {}
+
+    def stage(self, name):
+        if name not in self.stages:
+            self.stages[name] = Stage(self, name)
+        return self.stages[name]
+
+    def install(self):
+        for name in FS_FUNCTIONS:
+            fun = getattr(os, name)
+            self.wrapped[name] = fun
+            setattr(os, name, self.counted(fun))
+
+    def uninstall(self):
+        for name, fun in self.wrapped.items():
+            setattr(os, name, fun)
+        self.wrapped = {}
+
+    def counted(self, fun):
+        @functools.wraps(fun)
+        def wrapper(*args, **kwargs):
+            with self.lock:
+                self.fs_calls += 1
+            return fun(*args, **kwargs)
+        return wrapper
+
+    def as_dict(self):
+        stages = []
+        for r in self.stages.values():
+            stages.append({"stage": r.name, "seconds": r.seconds,
+                           "entries": r.entries, "changed": r.changed,
+                           "fs_calls": r.fs_calls})
+        return {"seconds": time.perf_counter() - self.started,
+                "fs_calls": self.fs_calls, "stages": stages}
+
+
+def stage(config, name):
+    # Stages are only kept when statistics are collected.
+    if config.stats is None:
+        return Stage(None, name)
+    return config.stats.stage(name)
+
+
+def action_stage_name(n, action):
+    return "action {}: {}".format(n, describe_action(action))
+
+
+def describe_action(action):
+    args = [str(a) for a in (action.arg1, action.arg2) if a is not None]
+    return " ".join([action.name] + args)
+
+
+def timed_step(record, step):
+    # Whether an entry changed is told by its full name before and after.
+    perf_counter = time.perf_counter
+
+    def timed(k, f):
+        before = f.full()
+        start = perf_counter()
+        kept = step(k, f)
+        record.seconds += perf_counter() - start
+        record.entries += 1
+        if (not kept) or (f.full() != before):
+            record.changed += 1
+        return kept
+    return timed
+
+
+def count_changes(record, names, fn_buffer):
+    record.entries += len(names)
+    record.changed += len(names) - len(fn_buffer)
+    for k, v in fn_buffer.items():
+        if v.full() != names[k]:
+            record.changed += 1
+
+
+def output_stats(config):
+    summary = config.stats.as_dict()
+    if config.stats_file is not None:
+        import json
+        with open(config.stats_file, "w") as f:
+            json.dump(summary, f, indent=2)
+            f.write("\n")
+    if config.stats_table:
+        print_stats(summary)
+
+
+def print_stats(summary):
+    rows = [(r["stage"], r["seconds"], r["entries"], r["changed"],
+             r["fs_calls"]) for r in summary["stages"]]
+    rows.append(("total", summary["seconds"], None, None,
+                 summary["fs_calls"]))
+    width = max(len(row[0]) for row in rows)
+    print("{:<{}} {:>10} {:>10} {:>10} {:>10} {:>12}".format(
+        "stage", width, "time (s)", "entries", "changed", "fs calls",
+        "entries/s"), file=sys.stderr)
+    for name, seconds, entries, changed, fs_calls in rows:
+        rate = ""
+        if entries and seconds:
+            rate = "{:.0f}".format(entries / seconds)
+        print("{:<{}} {:>10.4f} {:>10} {:>10} {:>10} {:>12}".format(
+            name, width, seconds, "" if entries is None else entries,
+            "" if changed is None else changed, fs_calls, rate),
+            file=sys.stderr)
+
+
+###############################################################################
+# GIT
+
+
+GIT_NULL_SHA = "0" * 40
+
+
+def git_move_file(config, old, new):
+    import subprocess
+    try:
+        subprocess.run(["git", "mv", old, new], cwd=config.directory,
+                       check=True)
+        return True
+    except subprocess.CalledProcessError as e:
+        report("error while git renaming {} to {}".format(old, new),
+               "error: {}".format(e))
+        return False
+    except Exception as e:
+        report("error while renaming {} to {}".format(old, new),
+               "error:  {}".format(e))
+        return False
+
+
+def git_output(args, cwd, stdin=None):
+    import subprocess
+    p = subprocess.run(["git"] + args, cwd=cwd, input=stdin, check=True,
+                       stdout=subprocess.PIPE)
+    return p.stdout
+
+
+def git_index_entries(config):
+    """ Return the git work tree root and a {path: (mode, sha, stage)} dict of
+    the index entries under the working directory, from one git ls-files.
+    """
+    top = git_output(["rev-parse", "--show-toplevel"], config.directory)
+    top = os.fsdecode(top).rstrip("\n")
+    listing = git_output(["ls-files", "-s", "-z", "--full-name", "--", "."],
+                         config.directory)
+    entries = {}
+    for record in os.fsdecode(listing).split("\0"):
+        if not record:
+            continue
+        info, path = record.split("\t", 1)
+        mode, sha, stage = info.split(" ")
+        if path in entries and stage != "0":
+            # Unmerged paths have several entries; keep a non-zero stage so
+            # that they are left to git mv, which will refuse them.
+            mode, sha = entries[path][:2]
+        entries[path] = (mode, sha, stage)
+    return top, entries
+
+
+def git_tracked_paths(config, entries, sources):
+    # Map each source path to the index entries it covers: the path itself
+    # for a file, every entry below it for a directory.
+    tracked = {}
+    for path in entries:
+        if path in sources:
+            tracked.setdefault(path, []).append(path)
+        if config.file_mode == 'f':
+            continue
+        d = path
+        while "/" in d:
+            d = d[:d.rindex("/")]
+            if d in sources:
+                tracked.setdefault(d, []).append(path)
+    return tracked
+
+
+def git_rename_files(config, renames, dependencies=None):
+    """ Rename files with a single git ls-files and a single index update.
+
+    Tracked files are moved on disk and their index entries are rewritten in
+    one git update-index call, untracked files are plainly renamed. If git
+    cannot be used in bulk, each tracked file is renamed with git mv instead.
+    As with execute_renames, a rename is skipped if one it depends on failed.
+    """
+    import subprocess
+    if dependencies is None:
+        dependencies = rename_dependencies(renames)
+    try:
+        top, entries = git_index_entries(config)
+    except (OSError, subprocess.CalledProcessError):
+        execute_renames(config, renames, dependencies)
+        return
+
+    # git reports the real path of the work tree, while ours may go through
+    # a symbolic link. Only the directory is resolved, as the entry itself
+    # may be a link.
+    top = os.path.realpath(top)
+    real_dirs = {}
+
+    def relpath(path):
+        head, tail = os.path.split(path)
+        if head not in real_dirs:
+            real_dirs[head] = os.path.realpath(head)
+        path = os.path.join(real_dirs[head], tail)
+        return os.path.relpath(path, top).replace(os.sep, "/")
+
+    sources = {relpath(old) for old, new in renames}
+    tracked = git_tracked_paths(config, entries, sources)
+    # Index paths already moved by earlier renames in the plan, such as the
+    # contents of a directory or the first hop through a temporary name.
+    current = {}
+    records = []
+    moved = []
+    failed = [False] * len(renames)
+
+    def blocked(i):
+        if any(failed[j] for j in dependencies[i]):
+            report("skipping {}: a rename it depends on failed".format(
+                renames[i][0]))
+            return True
+        return False
+
+    def update_index():
+        # Renames falling back to git mv need the index to match the disk,
+        # so the pending entries are written first.
+        if records:
+            stdin = os.fsencode("\0".join(records) + "\0")
+            del records[:]
+            try:
+                git_output(["update-index", "-z", "--index-info"], top, stdin)
+            except (OSError, subprocess.CalledProcessError) as e:
+                print("error while updating the git index:", e)
+                for i in reversed(moved):
+                    os.renames(renames[i][1], renames[i][0])
+                for i in moved:
+                    failed[i] = blocked(i) or not rename_file(config,
+                                                              *renames[i])
+        del moved[:]
+
+    for i, (old, new) in enumerate(renames):
+        if blocked(i):
+            failed[i] = True
+            continue
+        rel = relpath(old)
+        # Untracked entries are plainly renamed, which must not reach the
+        # repository itself, as git mv would refuse to.
+        if ".git" in rel.split("/") or ".git" in relpath(new).split("/"):
+            report("error while renaming {} to {}".format(old, new),
+                   "error: not renaming the .git directory or its contents")
+            failed[i] = True
+            continue
+        paths = []
+        for path in tracked.get(rel, []):
+            while path in current:
+                path = current[path]
+            paths.append(path)
+        if not paths:
+            failed[i] = not rename_file(config, old, new, git_mode=False)
+        elif any(entries[path][2] != "0" for path in paths):
+            update_index()
+            failed[i] = not rename_file(config, old, new)
+        elif rename_file(config, old, new, git_mode=False):
+            moved.append(i)
+            newrel = relpath(new)
+            tracked[newrel] = []
+            for path in paths:
+                newpath = newrel + path[len(rel):]
+                mode, sha, stage = entries[newpath] = entries.pop(path)
+                current[path] = newpath
+                tracked[newrel].append(newpath)
+                records.append("0 {} 0\t{}".format(GIT_NULL_SHA, path))
+                records.append("{} {} 0\t{}".format(mode, sha, newpath))
+        else:
+            failed[i] = True
+    update_index()
+
+
+###############################################################################
+# PATTERN COMPILATION
+
+
+def translate_pattern(pattern):
+    for old, new in PATTERN_ESCAPES:
+        pattern = pattern.replace(old, new)
+    for old, new in PATTERN_FIELDS:
+        pattern = pattern.replace(old, new)
+    return pattern
+
+
+def compile_template(template, ngroups, now, make_rng=None):
+    # {1}..{N} refer to source groups, {numX+Y} to the item counter and the
+    # date fields of now are resolved right away, those of each file's times
+    # and {rand} fields when it is matched; anything else is kept verbatim.
+    segments = []
+    pos = 0
+    for m in TEMPLATE_FIELD_REGEX.finditer(template):
+        segments.append(template[pos:m.start()])
+        field = m.group(1)
+        num = NUM_FIELD_REGEX.fullmatch(field)
+        rand = RAND_FIELD_REGEX.fullmatch(field)
+        if field.isdigit() and 1 <= int(field) <= ngroups:
+            segments.append(int(field) - 1)
+        elif num:
+            width = int(num.group(1)) if num.group(1) else 0
+            offset = int(num.group(2)) if num.group(2) else 0
+            segments.append((width, offset))
+        elif field in DATE_FIELDS:
+            segments.append(time.strftime(DATE_FIELDS[field], now))
+        elif field in FILE_DATE_FIELDS:
+            segments.append(FileDateField(*FILE_DATE_FIELDS[field]))
+        elif rand:
+            segments.append(compile_rand_field(rand, make_rng))
+        else:
+            segments.append(m.group(0))
+        pos = m.end()
+    segments.append(template[pos:])
+    return merge_literals(segments)
+
+
+def compile_rand_field(rand, make_rng=None):
+    # {rand} is 0 to 100, {randX} 0 to X and {randX-Y} X to Y, any of them
+    # padded to Z characters with ,Z. make_rng returns the generator to draw
+    # from, which is only created for templates that need one.
+    low, high, width = rand.groups()
+    if high is not None:
+        low, high = int(low or 0), int(high)
+    else:
+        low, high = 0, int(low) if low else 100
+    if make_rng is None:
+        import random
+        rng = random.Random()
+    else:
+        rng = make_rng()
+    return RandomField(low, high, int(width or 0), rng)
+
+
+def template_uses_file_dates(template):
+    return any(m.group(1) in FILE_DATE_FIELDS
+               for m in TEMPLATE_FIELD_REGEX.finditer(template))
+
+
+def merge_literals(segments):
+    merged = []
+    for seg in segments:
+        if type(seg) is str and merged and type(merged[-1]) is str:
+            merged[-1] += seg
+        elif seg != "":
+            merged.append(seg)
+    return merged
+
+
+def format_num_field(count, width, offset):
+    # {num2} is padded to 2 characters, {num3+10} is offset by 10 and padded.
+    return str(count + offset).zfill(width)
+
+
 ###############################################################################
 # LIST AND STRING MANGLING
 
@@ -468,6 +2697,8 @@ def parse_args(argv):
         elif argv[i] == "-g":
             if i+1 < l:
                 config.pattern = argv[i+1]
+                if GLOB_MAGIC_REGEX.search(split_glob(config.pattern)[0]):
+                    sys.exit(ERRMSGS["glob-directory"].format(config.pattern))
             else:
                 sys.exit(ERRMSGS["glob-arity"])
             i += 2
@@ -484,6 +2715,30 @@ def parse_args(argv):
                 if actions[-1].arg2 < 0:
                     sys.exit(ERRMSGS["insert-type-2"])
 
+        elif argv[i] == "-j":
+            if i+1 < l:
+                try:
+                    config.jobs = int(argv[i+1])
+                except ValueError:
+                    sys.exit(ERRMSGS["jobs-type"])
+                if config.jobs < 1:
+                    sys.exit(ERRMSGS["jobs-type"])
+            else:
+                sys.exit(ERRMSGS["jobs-arity"])
+            i += 2
+
+        elif argv[i] == "-P":
+            if i+1 < l:
+                try:
+                    config.processes = int(argv[i+1])
+                except ValueError:
+                    sys.exit(ERRMSGS["processes-type"])
+                if config.processes < 1:
+                    sys.exit(ERRMSGS["processes-type"])
+            else:
+                sys.exit(ERRMSGS["processes-arity"])
+            i += 2
+
         elif argv[i] == "-M":
             if argv[i+1] in ['f', 'd', 'b']:
                 config.file_mode = argv[i+1]
@@ -522,6 +2777,39 @@ def parse_args(argv):
             config.undo = True
             i += 1
 
+        elif argv[i] == "--stats":
+            config.stats_table = True
+            i += 1
+
+        elif argv[i] == "--stats-json":
+            if i+1 < l:
+                config.stats_file = argv[i+1]
+            else:
+                sys.exit(ERRMSGS["stats-arity"])
+            i += 2
+
+        elif argv[i] in ["--plan-json", "--plan-nul"]:
+            if i+1 < l:
+                config.plan_file = argv[i+1]
+                config.plan_format = argv[i][len("--plan-"):]
+            else:
+                sys.exit(ERRMSGS["plan-arity"].format(argv[i]))
+            i += 2
+
+        elif argv[i] == "--profile":
+            if i+1 < l:
+                config.profile = argv[i+1]
+            else:
+                sys.exit(ERRMSGS["profile-arity"])
+            i += 2
+
+        elif argv[i] == "--undo":
+            if i+1 < l:
+                config.replay = argv[i+1]
+            else:
+                sys.exit(ERRMSGS["undo-arity"])
+            i += 2
+
         elif argv[i] == "-v":
             msg = ERRMSGS["verbosity-arity"]
             i, actions = parse_one(argv, i, actions, "verbosity", msg)
@@ -544,6 +2832,78 @@ def parse_args(argv):
             config.git_mode = True
             i += 1
 
+        elif argv[i] == "--stream":
+            config.stream = True
+            i += 1
+
+        elif argv[i] == "--no-pager":
+            config.pager = False
+            i += 1
+
+        elif argv[i] == "--watch":
+            config.watch = True
+            i += 1
+
+        elif argv[i] == "--poll":
+            if i+1 < l:
+                try:
+                    config.poll = float(argv[i+1])
+                except ValueError:
+                    sys.exit(ERRMSGS["poll-type"])
+                if not config.poll > 0:
+                    sys.exit(ERRMSGS["poll-type"])
+            else:
+                sys.exit(ERRMSGS["poll-arity"])
+            i += 2
+
+        elif argv[i] == "--num-scope":
+            if i+1 < l:
+                if argv[i+1] in NUM_SCOPES:
+                    config.num_scope = argv[i+1]
+                else:
+                    sys.exit(ERRMSGS["num-scope-type"])
+            else:
+                sys.exit(ERRMSGS["num-scope-arity"])
+            i += 2
+
+        elif argv[i] == "--seed":
+            if i+1 < l:
+                try:
+                    config.seed = int(argv[i+1])
+                except ValueError:
+                    sys.exit(ERRMSGS["seed-type"])
+            else:
+                sys.exit(ERRMSGS["seed-arity"])
+            i += 2
+
+        elif argv[i] == "--manifest":
+            if i+1 < l:
+                config.manifest = argv[i+1]
+            else:
+                sys.exit(ERRMSGS["manifest-arity"])
+            i += 2
+
+        elif argv[i] == "--journal":
+            if i+1 < l:
+                config.journal_file = argv[i+1]
+            else:
+                sys.exit(ERRMSGS["journal-arity"])
+            i += 2
+
+        elif argv[i] == "--index":
+            if i+1 < l:
+                config.index_file = argv[i+1]
+            else:
+                sys.exit(ERRMSGS["index-arity"])
+            i += 2
+
+        elif argv[i] == "--resume":
+            if i+1 < l:
+                config.resume = argv[i+1]
+            else:
+                sys.exit(ERRMSGS["resume-arity"])
+            i += 2
+
         else:
             print(SHORT_USAGE)
             msg = "unrecognized flag: {}".format(argv[i])
@@ -596,6 +2956,12 @@ def parse_extension(argv, i, actions):
 # OUTPUT
 
 
+def report(*lines):
+    # Renames may run on several threads; keep each message in one piece.
+    with OUTPUT_LOCK:
+        print("\n".join(lines))
+
+
 def print_sep():
     print("-" * 70)
 
@@ -633,119 +2999,557 @@ def print_actions(actions):
 
 
 def print_fn_buffer(config, fn_buffer):
-    maxlen = 0
-    for k in fn_buffer.keys():
-        maxlen = max(maxlen, len(k))
-
     if config.recursive:
-        for k, v in sorted(fn_buffer.items()):
-            s = "{}{}=> {}".format(k, (" " * (maxlen-len(k)+1)), v.fullpath())
-            if len(s) > config.cols:
-                s = "{}\n    => {}".format(k, v.fullpath())
-            print(s)
+        lines = [(v.origpath(), v.fullpath())
+                 for k, v in sorted(fn_buffer.items())]
     else:
-        for k, v in sorted(fn_buffer.items()):
-            s = "{}{}=> {}".format(k, (" " * (maxlen-len(k)+1)), v.full())
-            if len(s) > config.cols:
-                s = "{}\n    => {}".format(k, v.full())
-            print(s)
+        lines = [(v.orig, v.full()) for k, v in sorted(fn_buffer.items())]
+    print_renames(config, lines)
     print()
 
 
+def print_renames(config, lines):
+    maxlen = 0
+    for old, new in lines:
+        maxlen = max(maxlen, len(old))
+
+    for old, new in lines:
+        s = "{}{}=> {}".format(old, (" " * (maxlen-len(old)+1)), new)
+        if len(s) > config.cols:
+            s = "{}\n    => {}".format(old, new)
+        print(s)
+
+
+###############################################################################
+# PAGER
+#
+# The interactive preview of large buffers: the sorted keys are all that is
+# computed up front, and only the rows on screen are formatted, so the first
+# screen shows up at once and moving around costs the same at any size.
+
+
+PAGER_HELP = ("[y]es [n]o  j/k line  space/b page  g/G first/last  Ng entry N"
+              "  /? search")
+# Keys sent by the arrow, page and home/end keys, after ESC [.
+PAGER_ESCAPES = {"A": "k", "B": "j", "5~": "b", "6~": " ", "H": "g",
+                 "F": "G", "1~": "g", "4~": "G"}
+
+
+class Pager:
+
+    def __init__(self, config, fn_buffer):
+        self.config = config
+        self.fn_buffer = fn_buffer
+        self.keys = sorted(fn_buffer)
+        self.top = 0
+        # last search pattern, and the entry it last matched
+        self.pattern = None
+        self.match = None
+
+    def height(self):
+        return max(self.config.rows - 1, 1)
+
+    def pair(self, i):
+        v = self.fn_buffer[self.keys[i]]
+        if self.config.recursive:
+            return v.origpath(), v.fullpath()
+        return v.orig, v.full()
+
+    def scroll(self, top):
+        last = max(len(self.keys) - self.height(), 0)
+        self.top = min(max(top, 0), last)
+
+    def render(self, status):
+        cols = self.config.cols
+        pairs = [self.pair(i) for i in range(
+            self.top, min(self.top + self.height(), len(self.keys)))]
+        maxlen = max((len(old) for old, new in pairs), default=0)
+        out = ["\x1b[H\x1b[2J"]
+        for old, new in pairs:
+            s = "{}{}=> {}".format(old, " " * (maxlen - len(old) + 1), new)
+            if len(s) > cols:
+                width = max((cols - 4) // 2, 2)
+                s = "{} => {}".format(shorten(old, width),
+                                      shorten(new, width))
+            out.append(s + "\n")
+        out.append("\n" * (self.height() - len(pairs)))
+        out.append("\x1b[7m" + status[:cols] + "\x1b[0m")
+        sys.stdout.write("".join(out))
+        sys.stdout.flush()
+
+    def status(self):
+        last = min(self.top + self.height(), len(self.keys))
+        return "{}-{} of {}  {}".format(self.top + 1, last, len(self.keys),
+                                        PAGER_HELP)
+
+    def search(self, pattern, backwards):
+        # Lines are formatted one at a time from the last match, or the top
+        # line, on, wrapping around, until one matches.
+        n = len(self.keys)
+        start = self.top if self.match is None else self.match
+        step = -1 if backwards else 1
+        for d in range(1, n + 1):
+            i = (start + step * d) % n
+            old, new = self.pair(i)
+            if (pattern in old) or (pattern in new):
+                return i
+        return None
+
+    def prompt(self, prefix):
+        text = ""
+        while True:
+            self.render(prefix + text)
+            ch = getch()
+            if ch in "\r\n":
+                return text
+            elif ch in "\x1b\x03":
+                return None
+            elif ch in "\x7f\b":
+                text = text[:-1]
+            elif ch.isprintable():
+                text += ch
+
+    def run(self):
+        """ Page through the renames until they are confirmed or not. """
+        sys.stdout.write("\x1b[?1049h")
+        try:
+            return self.loop()
+        finally:
+            sys.stdout.write("\x1b[?1049l")
+            sys.stdout.flush()
+
+    def loop(self):
+        count = ""
+        message = None
+        while True:
+            self.render(message or self.status())
+            message = None
+            key = read_key()
+            if key.isdigit():
+                count += key
+                message = ":" + count
+                continue
+            n, count = int(count) if count else None, ""
+            if key == "y":
+                return True
+            elif key in ("n", "q", "\x03"):
+                return False
+            elif key in ("j", "\r", "\n"):
+                self.scroll(self.top + (n or 1))
+            elif key == "k":
+                self.scroll(self.top - (n or 1))
+            elif key in (" ", "f"):
+                self.scroll(self.top + self.height())
+            elif key == "b":
+                self.scroll(self.top - self.height())
+            elif key == "g":
+                self.scroll((n or 1) - 1)
+            elif key == "G":
+                self.scroll(n - 1 if n else len(self.keys))
+            elif key in ("/", "?"):
+                pattern = self.prompt(key)
+                if pattern is None:
+                    continue
+                # An empty pattern repeats the last search.
+                if pattern:
+                    self.pattern = pattern
+                    self.match = None
+                if self.pattern is None:
+                    continue
+                self.match = self.search(self.pattern, key == "?")
+                if self.match is None:
+                    message = "not found: " + self.pattern
+                else:
+                    self.scroll(self.match)
+
+
+def shorten(path, width):
+    # The end of a path is kept, as that is where the names are.
+    if len(path) <= width:
+        return path
+    return "<" + path[len(path) - width + 1:]
+
+
+def read_key():
+    ch = getch()
+    if ch != "\x1b":
+        return ch
+    if getch() != "[":
+        return "\x1b"
+    seq = getch()
+    while seq[-1] in "0123456789;":
+        seq += getch()
+    return PAGER_ESCAPES.get(seq, "\x1b")
+
+
+def uses_pager(config, fn_buffer):
+    # Only for a preview that would not fit on the terminal it is shown on.
+    return (config.pager and not config.yes_mode and sys.stdin.isatty() and
+            sys.stdout.isatty() and len(fn_buffer) > config.rows - 2)
+
+
+###############################################################################
+# PLAN EXPORT
+#
+# --plan-json and --plan-nul write the planned renames for other programs:
+# one record per rename, with absolute paths, written as soon as the actions
+# on the entry are done instead of after the whole buffer is sorted and
+# formatted, and without keeping anything once it is written. As records go
+# out before the run is known to succeed, a last record tells whether the
+# plan is complete.
+
+
+class PlanWriter:
+    """ Writes renames as JSON lines, with the actions that changed each
+    entry, or as NUL separated pairs of old and new paths.
+
+    A complete plan ends with {"complete": true}, or with an empty pair. A
+    run stopped by an error ends the JSON lines with {"complete": false}.
+    """
+
+    def __init__(self, filename, fmt):
+        import json
+        self.dumps = json.dumps
+        self.fmt = fmt
+        if filename == "-":
+            sys.stdout.flush()
+            self.file = sys.stdout.buffer
+        else:
+            self.file = open(filename, "wb")
+        # descriptions of the actions that changed each entry being processed
+        self.trace = {}
+
+    def traced(self, action, step):
+        trace = self.trace
+        description = describe_action(action)
+
+        def traced(k, f):
+            before = f.full()
+            kept = step(k, f)
+            if kept and (f.full() != before):
+                trace.setdefault(k, []).append(description)
+            return kept
+        return traced
+
+    def entry(self, k, f):
+        """ Write the rename of a processed entry, if it is renamed. """
+        actions = self.trace.pop(k, [])
+        if f.full() == f.orig:
+            return
+        if self.fmt == "json":
+            record = {"old": f.origpath(), "new": f.fullpath(),
+                      "actions": actions}
+            self.file.write(self.dumps(record).encode() + b"\n")
+        else:
+            self.file.write(os.fsencode(f.origpath()) + b"\0" +
+                            os.fsencode(f.fullpath()) + b"\0")
+
+    def discard(self, k):
+        # An entry dropped by an action is not renamed.
+        self.trace.pop(k, None)
+
+    def close(self, complete=True):
+        if self.fmt == "json":
+            record = {"complete": complete}
+            self.file.write(self.dumps(record).encode() + b"\n")
+        elif complete:
+            self.file.write(b"\0\0")
+        if self.file is sys.stdout.buffer:
+            self.file.flush()
+        else:
+            self.file.close()
+
+
+def check_plannable(config, jobs):
+    if config.watch:
+        sys.exit(ERRMSGS["plan-unsupported"].format("--watch"))
+    if any(per_action_output(job.actions) for job in jobs):
+        sys.exit(ERRMSGS["plan-unsupported"].format("-v 3"))
+
+
+def open_plan(config):
+    if config.plan_file is not None:
+        config.plan = PlanWriter(config.plan_file, config.plan_format)
+
+
+def close_plan(config, complete=True):
+    if config.plan is not None:
+        config.plan.close(complete)
+        config.plan = None
+
+
 ###############################################################################
 # ACTION HANDLERS
 
 
 def handle_actions(config, actions):
-    fn_buffer = init_fn_buffer(config)
-    for action in actions:
-        fn_buffer = ACTION_HANDLERS[action.name](config, action, fn_buffer)
+    if uses_file_dates(actions):
+        config.file_times = {}
+    with stage(config, "listing") as record:
+        fn_buffer = init_fn_buffer(config)
+        record.entries += len(fn_buffer)
+    return clean_fn_buffer(apply_actions(config, actions, fn_buffer,
+                                         config.plan))
+
+
+def apply_actions(config, actions, fn_buffer, plan=None):
+    # The actions that change each entry are only traced in this process.
+    if per_action_output(actions):
+        return handle_actions_staged(config, actions, fn_buffer)
+    elif ((config.processes > 1) and (len(fn_buffer) > PARALLEL_CHUNK) and
+          (config.plan is None)):
+        return handle_actions_parallel(config, actions, fn_buffer)
+    else:
+        return handle_actions_fused(config, actions, fn_buffer, plan)
+
+
+def handle_actions_staged(config, actions, fn_buffer):
+    # One sweep over the buffer per action, so that the buffer state after
+    # each action can be shown at verbosity level 3.
+    index = CollisionIndex()
+    for n, action in enumerate(actions):
+        names = None
+        if config.stats is not None:
+            names = {k: v.full() for k, v in fn_buffer.items()}
+        with stage(config, action_stage_name(n, action)) as record:
+            fn_buffer = ACTION_HANDLERS[action.name](config, action,
+                                                     fn_buffer)
+        if names is not None:
+            count_changes(record, names, fn_buffer)
         if (config.verbosity > 2) and (action.name != "verbosity"):
-            print_sep()
-            print_action(action)
-            print_fn_buffer(config, fn_buffer)
-        verify_fn_buffer(fn_buffer)
-    return clean_fn_buffer(fn_buffer)
+            with stage(config, "print"):
+                print_sep()
+                print_action(action)
+                print_fn_buffer(config, fn_buffer)
+        with stage(config, "verify") as record:
+            verify_fn_buffer(fn_buffer, index)
+            record.entries += len(fn_buffer)
+    return fn_buffer
+
+
+def handle_actions_fused(config, actions, fn_buffer, plan=None):
+    # The action list is compiled into a chain of per-entry steps and run in
+    # a single pass. Only the final names are checked for duplicates, as each
+    # entry is done, so the run stops at the first one and no state is kept
+    # for the intermediate names. With a plan, each entry is written to it as
+    # soon as its steps are done.
+    steps = compile_actions(config, actions)
+    index = CollisionIndex()
+    new_fn_buffer = {}
+    for k, v in fn_buffer.items():
+        for step in steps:
+            if not step(k, v):
+                if plan is not None:
+                    plan.discard(k)
+                break
+        else:
+            if not index.add(v):
+                exit_duplicate(v.full())
+            new_fn_buffer[k] = v
+            if plan is not None:
+                plan.entry(k, v)
+    return new_fn_buffer
+
+
+def handle_actions_parallel(config, actions, fn_buffer):
+    # Like handle_actions_fused, but the steps run on a pool of processes,
+    # in chunks of PARALLEL_CHUNK entries that only carry the name parts, and
+    # the results are merged back in buffer order. A step that needs state
+    # of the run, see parallel_segments, runs here between the chunks, and
+    # {num} counts are assigned here before the chunks are sent, so the
+    # output is the same as that of the fused pass.
+    from concurrent.futures import ProcessPoolExecutor
+
+    for action in actions:
+        if action.name == "verbosity":
+            verbosity_step(config, action)
+    actions = [a for a in actions if a.name != "verbosity"]
+    segments = parallel_segments(config, actions)
+    alive = list(fn_buffer.items())
+    pooled = [seg for seg in segments if seg[2]]
+    setup = (config.now, config.num_scope,
+             [[(a.name, a.arg1, a.arg2) for a in actions[start:end]]
+              for start, end, pool in pooled])
+    with stage(config, "actions"), ProcessPoolExecutor(
+            max_workers=config.processes, initializer=init_worker,
+            initargs=setup) as executor:
+        n = 0
+        for start, end, pool in segments:
+            if pool:
+                alive = run_pooled_segment(config, executor, n, actions[start],
+                                           alive)
+                n += 1
+            else:
+                step = ACTION_STEPS[actions[start].name](config,
+                                                         actions[start])
+                alive = [(k, v) for k, v in alive if step(k, v)]
+    index = CollisionIndex()
+    for k, v in alive:
+        if not index.add(v):
+            exit_duplicate(v.full())
+    return dict(alive)
+
+
+def parallel_segments(config, actions):
+    """ Split the actions into (start, end, pooled) segments. Tokenizing asks
+    for input, and {rand} and file date fields depend on state kept in this
+    process, so these run here, one action per segment. A {num} field needs
+    the count of each entry, so it starts a new pooled segment.
+    """
+    segments = []
+    for i, action in enumerate(actions):
+        pooled = True
+        counted = False
+        if action.name == "tokenize":
+            pooled = False
+        elif action.name == "pattern":
+            matcher = PatternMatcher(action.arg1, action.arg2)
+            pooled = all(type(seg) in (str, int, tuple)
+                         for seg in matcher.segments)
+            counted = matcher.uses_counter()
+        if pooled and segments and segments[-1][2] and not counted:
+            segments[-1][1] = i + 1
+        else:
+            segments.append([i, i + 1, pooled])
+    return segments
+
+
+def run_pooled_segment(config, executor, n, first, alive):
+    counts = None
+    if (first.name == "pattern" and
+            PatternMatcher(first.arg1, first.arg2).uses_counter()):
+        scope = NUM_SCOPES[config.num_scope]
+        seen = {}
+        counts = []
+        for k, v in alive:
+            key = scope(v)
+            count = seen.get(key, 0)
+            seen[key] = count + 1
+            counts.append(count)
+    chunks = []
+    for i in range(0, len(alive), PARALLEL_CHUNK):
+        chunk = [(v.path, v.name, v.ext, v.orig)
+                 for k, v in alive[i:i + PARALLEL_CHUNK]]
+        chunks.append((n, chunk, counts[i:i + PARALLEL_CHUNK]
+                       if counts is not None else None))
+    kept = []
+    i = 0
+    for results in executor.map(run_worker_chunk, chunks):
+        for name, ext in results:
+            k, v = alive[i]
+            i += 1
+            if name is not None:
+                v.name = name
+                v.ext = ext
+                kept.append((k, v))
+    return kept
+
+
+def init_worker(now, num_scope, segments):
+    config = Config()
+    config.now = now
+    config.num_scope = num_scope
+    WORKER_STEPS[:] = [[worker_step(config, Action(*a)) for a in segment]
+                       for segment in segments]
+
+
+def worker_step(config, action):
+    # Steps of a pooled segment take the entry's {num} count as an argument,
+    # which only the first step of a segment may use.
+    if action.name == "pattern":
+        matcher = PatternMatcher(action.arg1, action.arg2, config.now)
+
+        def step(f, count):
+            n = process_pattern_match(f.name, matcher, count)
+            if n:
+                f.set_name(n)
+                return True
+            return False
+        return step
+    inner = ACTION_STEPS[action.name](config, action)
+    return lambda f, count: inner(None, f)
+
+
+def run_worker_chunk(task):
+    # Returns, for each entry, its name and extension after the segment, or
+    # None if a step dropped it.
+    n, chunk, counts = task
+    steps = WORKER_STEPS[n]
+    results = []
+    for i, (path, name, ext, orig) in enumerate(chunk):
+        f = File(path, name, ext, orig)
+        count = counts[i] if counts is not None else 0
+        if all(step(f, count) for step in steps):
+            results.append((f.name, f.ext))
+        else:
+            results.append((None, None))
+    return results
+
+
+def compile_actions(config, actions):
+    steps = []
+    for n, action in enumerate(actions):
+        step = ACTION_STEPS[action.name](config, action)
+        if step is not None:
+            if config.plan is not None:
+                step = config.plan.traced(action, step)
+            if config.stats is not None:
+                name = action_stage_name(n, action)
+                step = timed_step(config.stats.stage(name), step)
+            steps.append(step)
+    return steps
+
+
+def apply_step(step, fn_buffer):
+    new_fn_buffer = {}
+    for k, v in fn_buffer.items():
+        if step(k, v):
+            new_fn_buffer[k] = v
+    return new_fn_buffer
 
 
 def handle_camel_case(config, action, fn_buffer):
-    for k, v, in fn_buffer.items():
-        fn_buffer[k].set_name(process_camel_case(v.name, action.arg1))
-    return fn_buffer
+    return apply_step(camel_case_step(config, action), fn_buffer)
 
 
 def handle_case(config, action, fn_buffer):
-    for k, v in fn_buffer.items():
-        fn_buffer[k].set_name(process_case(action.arg1, v.name))
-    return fn_buffer
+    return apply_step(case_step(config, action), fn_buffer)
 
 
 def handle_file(config, action, fn_buffer):
-    new_fn_buffer = fn_buffer.copy()
-    for k in fn_buffer.keys():
-        if (k != action.arg1):
-            del new_fn_buffer[k]
-    return new_fn_buffer
+    return apply_step(file_step(config, action), fn_buffer)
 
 
 def handle_delete(config, action, fn_buffer):
-    for k, v in fn_buffer.items():
-        fn_buffer[k].set_name(process_delete(action.arg1, action.arg2, v.name))
-    return fn_buffer
+    return apply_step(delete_step(config, action), fn_buffer)
 
 
 def handle_extension(config, action, fn_buffer):
-    for k, v in fn_buffer.items():
-        name, ext = process_extension(action.arg1, action.arg2, v.name)
-        fn_buffer[k].set_name(name)
-        fn_buffer[k].set_ext(ext)
-    return fn_buffer
+    return apply_step(extension_step(config, action), fn_buffer)
 
 
 def handle_insert(config, action, fn_buffer):
-    for k, v in fn_buffer.items():
-        n = process_insert(fn_buffer[k].name, action.arg1, action.arg2)
-        fn_buffer[k].set_name(n)
-    return fn_buffer
+    return apply_step(insert_step(config, action), fn_buffer)
 
 
 def handle_pattern_match(config, action, fn_buffer):
-    count = 0
-    new_fn_buffer = fn_buffer.copy()
-    for k, v in fn_buffer.items():
-        n = process_pattern_match(v.name, action.arg1, action.arg2, count)
-        if n:
-            new_fn_buffer[k].set_name(n)
-        else:
-            del new_fn_buffer[k]
-        count += 1
-    return new_fn_buffer
+    return apply_step(pattern_match_step(config, action), fn_buffer)
 
 
 def handle_replace(config, action, fn_buffer):
-    for k, v in fn_buffer.items():
-        n = process_replace(v.name, action.arg1, action.arg2)
-        fn_buffer[k].set_name(n)
-    return fn_buffer
+    return apply_step(replace_step(config, action), fn_buffer)
 
 
 def handle_sanitize(config, action, fn_buffer):
-    for k, v in fn_buffer.items():
-        fn_buffer[k].set_name(process_sanitize(v.name))
-    return fn_buffer
+    return apply_step(sanitize_step(config, action), fn_buffer)
 
 
 def handle_substitute(config, action, fn_buffer):
-    for k, v in fn_buffer.items():
-        n = process_substitute(action.arg1, v.name)
-        fn_buffer[k].set_name(n)
-    return fn_buffer
+    return apply_step(substitute_step(config, action), fn_buffer)
 
 
 def handle_tokenize(config, action, fn_buffer):
-    for k, v in fn_buffer.items():
-        fn_buffer[k].set_name(process_tokenize(action.arg1, v.name))
-    return fn_buffer
+    return apply_step(tokenize_step(config, action), fn_buffer)
 
 
 def handle_verbosity(config, action, fn_buffer):
@@ -753,6 +3557,117 @@ def handle_verbosity(config, action, fn_buffer):
     return fn_buffer
 
 
+###############################################################################
+# ACTION STEPS
+#
+# Each function takes an action and returns a step: a function applied to a
+# single buffer entry, which returns False if the entry is to be dropped.
+
+
+def camel_case_step(config, action):
+    def step(k, f):
+        f.set_name(process_camel_case(f.name, action.arg1))
+        return True
+    return step
+
+
+def case_step(config, action):
+    fun = CASE_FUNS[action.arg1]
+
+    def step(k, f):
+        f.set_name(fun(f.name))
+        return True
+    return step
+
+
+def file_step(config, action):
+    def step(k, f):
+        return action.arg1 in (f.orig, f.origpath())
+    return step
+
+
+def delete_step(config, action):
+    def step(k, f):
+        f.set_name(process_delete(action.arg1, action.arg2, f.name))
+        return True
+    return step
+
+
+def extension_step(config, action):
+    def step(k, f):
+        name, ext = process_extension(action.arg1, action.arg2, f.name)
+        f.set_name(name)
+        f.set_ext(ext)
+        return True
+    return step
+
+
+def insert_step(config, action):
+    def step(k, f):
+        f.set_name(process_insert(f.name, action.arg1, action.arg2))
+        return True
+    return step
+
+
+def pattern_match_step(config, action):
+    matcher = PatternMatcher(action.arg1, action.arg2, config.now,
+                             config.random)
+    dates = matcher.uses_file_dates()
+    # One counter per scope, advanced as the entries are met in buffer
+    # order, so numbering takes a single pass whatever the scope.
+    scope = NUM_SCOPES[config.num_scope]
+    counts = {}
+
+    def step(k, f):
+        key = scope(f)
+        count = counts.get(key, 0)
+        counts[key] = count + 1
+        t = file_times(config, f) if dates else None
+        n = process_pattern_match(f.name, matcher, count, t)
+        if n:
+            f.set_name(n)
+            return True
+        return False
+    return step
+
+
+def replace_step(config, action):
+    def step(k, f):
+        f.set_name(process_replace(f.name, action.arg1, action.arg2))
+        return True
+    return step
+
+
+def sanitize_step(config, action):
+    def step(k, f):
+        f.set_name(process_sanitize(f.name))
+        return True
+    return step
+
+
+def substitute_step(config, action):
+    fun = SUBSTITUTE_FUNS[action.arg1]
+
+    def step(k, f):
+        f.set_name(fun(f.name))
+        return True
+    return step
+
+
+def tokenize_step(config, action):
+    def step(k, f):
+        f.set_name(process_tokenize(action.arg1, f.name))
+        return True
+    return step
+
+
+def verbosity_step(config, action):
+    # Verbosity only matters for output, so it is applied when the chain is
+    # compiled and does not take part in the pass over the buffer.
+    process_verbosity(config, action.arg1)
+    return None
+
+
 ###############################################################################
 # ACTION PROCESSORS
 
@@ -764,10 +3679,6 @@ def process_camel_case(name, mode):
         return join_camel_case(name)
 
 
-def process_case(mode, name):
-    return CASE_FUNS[mode](name)
-
-
 def process_delete(ini, end, name):
     if end == "end":
         end = len(name)
@@ -820,130 +3731,8 @@ def process_insert(name, text, pos):
     return newname
 
 
-def process_pattern_match(name, pattern_ini, pattern_end, count):
-    pattern = pattern_ini
-    pattern = pattern.replace(".", "\.")
-    pattern = pattern.replace("[", "\[")
-    pattern = pattern.replace("]", "\]")
-    pattern = pattern.replace("(", "\(")
-    pattern = pattern.replace(")", "\)")
-    pattern = pattern.replace("?", "\?")
-    pattern = pattern.replace("{#}", "([0-9]*)")
-    pattern = pattern.replace("{L}", "([a-zA-Z]*)")
-    pattern = pattern.replace("{C}", "([\S]*)")
-    pattern = pattern.replace("{X}", "([\S\s]*)")
-    pattern = pattern.replace("{@}", "(.*)")
-    repattern = re.compile(pattern)
-    newname = pattern_end
-    try:
-        search = repattern.search(name)
-        if search:
-            groups = search.groups()
-            for i in range(len(groups)):
-                newname = newname.replace("{" + str(i+1) + "}", groups[i])
-        else:
-            return None
-    except Exception as e:
-        return None
-
-    # Replace {num} with item number.
-    # If {num2} the number will be 02
-    # If {num3+10} the number will be 010
-    count = str(count)
-    cr = re.compile("{(num)([0-9]*)}|{(num)([0-9]*)(\+)([0-9]*)}")
-    try:
-        cg = cr.search(newname).groups()
-        if len(cg) == 6:
-            if cg[0] == "num":
-                # {num2}
-                if cg[1] != "":
-                    count = count.zfill(int(cg[1]))
-                newname = cr.sub(count, newname)
-            elif cg[2] == "num" and cg[4] == "+":
-                # {num2+5}
-                if cg[5] != "":
-                    count = str(int(count)+int(cg[5]))
-                if cg[3] != "":
-                    count = count.zfill(int(cg[3]))
-        newname = cr.sub(count, newname)
-    except:
-        pass
-
-    # Some date replacements
-    n = newname
-    n = n.replace("{date}",      time.strftime("%Y-%m-%d", time.localtime()))
-    n = n.replace("{year}",      time.strftime("%Y",       time.localtime()))
-    n = n.replace("{month}",     time.strftime("%m",       time.localtime()))
-    n = n.replace("{monthname}", time.strftime("%B",       time.localtime()))
-    n = n.replace("{monthsimp}", time.strftime("%b",       time.localtime()))
-    n = n.replace("{day}",       time.strftime("%d",       time.localtime()))
-    n = n.replace("{dayname}",   time.strftime("%A",       time.localtime()))
-    n = n.replace("{daysimp}",   time.strftime("%a",       time.localtime()))
-    newname = n
-
-    # Replace {rand} with random number between 0 and 100.
-    # If {rand500} the number will be between 0 and 500
-    # If {rand10-20} the number will be between 10 and 20
-    # If you add ,[ 5 the number will be padded with 5 digits
-    # ie. {rand20,5} will be a number between 0 and 20 of 5 digits (00012)
-    rnd = ""
-    cr = re.compile("{(rand)([0-9]*)}"
-                    "|{(rand)([0-9]*)(\-)([0-9]*)}"
-                    "|{(rand)([0-9]*)(\,)([0-9]*)}"
-                    "|{(rand)([0-9]*)(\-)([0-9]*)(\,)([0-9]*)}")
-    try:
-        cg = cr.search(newname).groups()
-        if len(cg) == 16:
-            if (cg[0] == "rand"):
-                if (cg[1] == ""):
-                    # {rand}
-                    rnd = random.randint(0, 100)
-                else:
-                    # {rand2}
-                    rnd = random.randint(0, int(cg[1]))
-            elif rand_case_1(cg):
-                # {rand10-100}
-                rnd = random.randint(int(cg[3]), int(cg[5]))
-            elif rand_case_2(cg):
-                if (cg[7] == ""):
-                    # {rand,2}
-                    rnd = str(random.randint(0, 100)).zfill(int(cg[9]))
-                else:
-                    # {rand10,2}
-                    rnd = str(random.randint(0, int(cg[7]))).zfill(int(cg[9]))
-            elif rand_case_3(cg):
-                # {rand2-10,3}
-                s = str(random.randint(int(cg[11]), int(cg[13])))
-                rnd = s.zfill(int(cg[15]))
-        newname = cr.sub(str(rnd), newname)
-    except:
-        pass
-    return newname
-
-
-def rand_case_1(cg):
-    r = ((cg[2] == "rand") and
-         (cg[4] == "-") and
-         (cg[3] != "") and
-         (cg[5] != ""))
-    return r
-
-
-def rand_case_2(cg):
-    r = ((cg[6] == "rand") and
-         (cg[8] == ",") and
-         (cg[9] != ""))
-    return r
-
-
-def rand_case_3(cg):
-    r = ((cg[10] == "rand") and
-         (cg[12] == "-") and
-         (cg[14] == ",") and
-         (cg[11] != "") and
-         (cg[13] != "") and
-         (cg[15] != ""))
-    return r
+def process_pattern_match(name, matcher, count, times=None):
+    return matcher.match(name, count, times)
 
 
 def process_replace(name, old, new):
@@ -954,10 +3743,6 @@ def process_sanitize(name):
     return " ".join(split_alphanumeric(name))
 
 
-def process_substitute(mode, name):
-    return SUBSTITUTE_FUNS[mode](name)
-
-
 def process_tokenize(mode, name):
     refs = "0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
     tokens = split_alphanumeric(name)
@@ -1022,6 +3807,25 @@ ACTION_HANDLERS = {
     "tokenize": handle_tokenize,
     "verbosity": handle_verbosity
 }
+ACTION_STEPS = {
+    "camelcase": camel_case_step,
+    "case": case_step,
+    "delete": delete_step,
+    "extension": extension_step,
+    "file": file_step,
+    "insert": insert_step,
+    "pattern": pattern_match_step,
+    "replace": replace_step,
+    "sanitize": sanitize_step,
+    "substitute": substitute_step,
+    "tokenize": tokenize_step,
+    "verbosity": verbosity_step
+}
+NUM_SCOPES = {
+    "global": lambda f: None,
+    "dir": lambda f: f.path,
+    "ext": lambda f: f.ext.lower()
+}
 CASE_FUNS = {
     "uc": lambda x: x.upper(),
     "lc": lambda x: x.lower(),
@@ -1048,6 +3852,8 @@ SUBSTITUTE_FUNS = {
 
 
 def getch():
+    import tty
+    import termios
     fd = sys.stdin.fileno()
     old_settings = termios.tcgetattr(fd)
     try:
@@ -1072,6 +3878,15 @@ def obtain_confirmation(config, filename_fn_buffer):
             sys.exit("unrecognized input")
 
 
+def uses_file_dates(actions):
+    return any((a.name == "pattern") and template_uses_file_dates(a.arg2)
+               for a in actions)
+
+
+def per_action_output(actions):
+    return any((a.name == "verbosity") and (a.arg1 > 2) for a in actions)
+
+
 def verbosity_set(actions):
     l = [(a.name == "verbosity") and (a.arg1 > 1) for a in actions]
     r = functools.reduce(lambda x, y: x or y, l, False)
@@ -1080,21 +3895,122 @@ def verbosity_set(actions):
 
 def main():
     config, actions = parse_args(sys.argv)
-
-    if len(actions) > 0:
-        if verbosity_set(actions):
+    if config.git_mode and (config.journal_file is not None):
+        sys.exit(ERRMSGS["journal-git"])
+    if (config.poll is not None) and not config.watch:
+        sys.exit(ERRMSGS["poll-watch"])
+
+    if config.stats_table or (config.stats_file is not None):
+        config.stats = Stats()
+        config.stats.install()
+    try:
+        if config.profile is not None:
+            import cProfile
+            profiler = cProfile.Profile()
+            try:
+                profiler.runcall(run, config, actions)
+            finally:
+                profiler.dump_stats(config.profile)
+        else:
+            run(config, actions)
+    finally:
+        if config.stats is not None:
+            config.stats.uninstall()
+            output_stats(config)
+
+
+def run(config, actions):
+    if (config.resume is not None) or (config.replay is not None):
+        # Replaying renames runs no actions, only -v applies.
+        for action in actions:
+            if action.name == "verbosity":
+                process_verbosity(config, action.arg1)
+    if config.resume is not None:
+        resume_renames(config)
+        return
+    if config.replay is not None:
+        replay_undo_script(config)
+        return
+
+    jobs = None
+    if config.manifest is not None:
+        # The command line is the first job, and the listing is left to the
+        # filters of each job.
+        jobs = [Job(config.pattern, config.file_mode, actions)]
+        jobs.extend(read_manifest(config.manifest))
+        for job in jobs:
+            if split_glob(job.pattern)[0]:
+                sys.exit(ERRMSGS["manifest-glob"].format(job.pattern))
+        config.pattern = None
+        config.file_mode = 'b'
+
+    if (len(actions) > 0) or (jobs is not None):
+        if config.stream:
+            check_streamable(config, actions)
+        if config.watch:
+            check_watchable(config, actions)
+        if config.plan_file is not None:
+            check_plannable(config, jobs or [Job(None, None, actions)])
+        if verbosity_set(actions) and (jobs is not None):
+            for job in jobs:
+                print_actions(job.actions)
+        elif verbosity_set(actions):
             print_actions(actions)
 
-        fn_buffer = handle_actions(config, actions)
+        if config.watch:
+            open_journal(config, config.journal_file)
+            try:
+                watch(config, actions)
+            finally:
+                close_journal(config)
+            return
 
-        if 1 <= config.verbosity <= 2:
-            print_fn_buffer(config, fn_buffer)
-        confirmed = obtain_confirmation(config, fn_buffer)
+        if config.stream:
+            open_plan(config)
+            try:
+                with stage(config, "stream"):
+                    plan = handle_actions_streaming(config, actions)
+            except BaseException:
+                close_plan(config, complete=False)
+                raise
+            close_plan(config)
+            if 1 <= config.verbosity <= 2:
+                print()
+            if obtain_confirmation(config, None):
+                open_journal(config, config.journal_file)
+                with stage(config, "rename"):
+                    rename_streamed(config, plan)
+                close_journal(config)
+            return
+
+        # The plan is complete before confirmation is asked for.
+        open_plan(config)
+        try:
+            if jobs is not None:
+                fn_buffer = handle_jobs(config, jobs)
+            else:
+                fn_buffer = handle_actions(config, actions)
+        except BaseException:
+            close_plan(config, complete=False)
+            raise
+        close_plan(config)
+
+        if (1 <= config.verbosity <= 2) and uses_pager(config, fn_buffer):
+            confirmed = Pager(config, fn_buffer).run()
+        else:
+            if 1 <= config.verbosity <= 2:
+                with stage(config, "print") as record:
+                    print_fn_buffer(config, fn_buffer)
+                    record.entries += len(fn_buffer)
+            confirmed = obtain_confirmation(config, fn_buffer)
 
         if config.undo:
-            output_undo_script(fn_buffer)
+            output_undo_script(config, fn_buffer)
         if confirmed:
-            rename_files(config, fn_buffer)
+            open_journal(config, config.journal_file)
+            with stage(config, "rename"):
+                rename_files(config, fn_buffer)
+            close_journal(config)
 
 ###############################################################################
 if (__name__ == "__main__"):
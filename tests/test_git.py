@@ -0,0 +1,86 @@
+import os
+import shutil
+import tempfile
+import unittest
+import subprocess
+import importlib.util
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+spec = importlib.util.spec_from_file_location(
+    "name_pryer", os.path.join(HERE, os.pardir, "name_pryer.py"))
+np = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(np)
+
+
+@unittest.skipIf(shutil.which("git") is None, "git is not installed")
+class GitModeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        os.chdir(self.tmp)
+        self.git("init", "-q")
+        for name in ("a", "b"):
+            with open(name, "w") as f:
+                f.write(name)
+        self.git("add", "a", "b")
+        self.git("commit", "-q", "-m", "init")
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp)
+
+    def git(self, *args):
+        p = subprocess.run(["git", "-c", "user.name=test",
+                            "-c", "user.email=test@example.com"] + list(args),
+                           check=True, stdout=subprocess.PIPE)
+        return p.stdout.decode()
+
+    def run_np(self, *args):
+        config, actions = np.parse_args(["name_pryer", "--git", "-y",
+                                         "-v", "0"] + list(args))
+        np.run(config, actions)
+
+    def read(self, name):
+        with open(name) as f:
+            return f.read()
+
+    def assertIndexConsistent(self, tracked):
+        # The index holds the tracked files under their new names, with
+        # their contents, and nothing is left deleted or unstaged.
+        self.assertEqual(sorted(self.git("ls-files").split()), tracked)
+        self.assertEqual(self.git("diff", "--name-only"), "")
+        for line in self.git("status", "--porcelain").splitlines():
+            self.assertNotIn("D", line[:2])
+
+    def test_index_consistent(self):
+        os.mkdir("dir")
+        for name in ("c", "d"):
+            with open(os.path.join("dir", name), "w") as f:
+                f.write(name)
+        self.git("add", "dir")
+        self.git("commit", "-q", "-m", "dir")
+        open("u", "w").close()
+
+        # A swap, through a temporary name.
+        self.run_np("-r", "a", "x", "-r", "b", "a", "-r", "x", "b")
+        self.assertEqual(self.read("a"), "b")
+        self.assertIndexConsistent(["a", "b", "dir/c", "dir/d"])
+
+        # A directory and the tracked and untracked entries around it.
+        self.run_np("-R", "-M", "b", "-c", "uc")
+        self.assertTrue(os.path.isdir(os.path.join(".git", "objects")))
+        self.assertEqual(self.read(os.path.join("DIR", "C")), "c")
+        self.assertTrue(os.path.exists("U"))
+        self.assertIndexConsistent(["A", "B", "DIR/C", "DIR/D"])
+
+    def test_skip_rename_into_failed_source(self):
+        # b cannot be renamed, so a must not be renamed over it.
+        self.run_np("-r", "b", "x" * 300, "-r", "a", "b")
+        self.assertEqual(self.read("a"), "a")
+        self.assertEqual(self.read("b"), "b")
+        self.assertEqual(self.git("status", "--short"), "")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,101 @@
+import os
+import shutil
+import tempfile
+import unittest
+import importlib.util
+from unittest import mock
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+spec = importlib.util.spec_from_file_location(
+    "name_pryer", os.path.join(HERE, os.pardir, "name_pryer.py"))
+np = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(np)
+
+# A chain a -> b -> c -> d and an independent rename of e.
+ACTIONS = ["-r", "c", "d", "-r", "b", "c", "-r", "a", "b", "-r", "e", "E"]
+RENAMED = {"b": "a", "c": "b", "d": "c", "E": "e"}
+
+
+class Crash(BaseException):
+    # Not caught by the error handling of renames, as a kill is not.
+    pass
+
+
+class ResumeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        os.chdir(self.tmp)
+        self.make_tree("t")
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp)
+
+    def make_tree(self, root):
+        os.mkdir(root)
+        for name in ("a", "b", "c", "e"):
+            with open(os.path.join(root, name), "w") as f:
+                f.write(name)
+
+    def run_np(self, *args):
+        config, actions = np.parse_args(["name_pryer", "-y", "-v", "0"] +
+                                        list(args))
+        np.run(config, actions)
+
+    def contents(self, root="t"):
+        result = {}
+        for name in os.listdir(root):
+            with open(os.path.join(root, name)) as f:
+                result[name] = f.read()
+        return result
+
+    def crash_after(self, n):
+        # Renames n entries, then fails as if the process were killed.
+        renames = os.renames
+        calls = []
+
+        def crashing_renames(old, new):
+            if len(calls) == n:
+                raise Crash()
+            calls.append(old)
+            renames(old, new)
+        return mock.patch.object(np.os, "renames", crashing_renames)
+
+    def test_resume_interrupted_run(self):
+        for n in range(4):
+            with self.subTest(crash_after=n):
+                root = "t{}".format(n)
+                journal = "journal{}".format(n)
+                self.make_tree(root)
+                with self.crash_after(n), self.assertRaises(Crash):
+                    self.run_np("-D", root, "--journal", journal, *ACTIONS)
+                self.run_np("--resume", journal)
+                self.assertEqual(self.contents(root), RENAMED)
+
+    def test_resume_completed_run_without_outcomes(self):
+        # Every rename was made, but none of their outcomes reached the
+        # journal: none may be made again.
+        self.run_np("-D", "t", "--journal", "journal", *ACTIONS)
+        with open("journal") as f:
+            lines = [line for line in f if not line.startswith('["done"')]
+        with open("journal", "w") as f:
+            f.writelines(lines)
+        self.run_np("--resume", "journal")
+        self.assertEqual(self.contents(), RENAMED)
+
+    def test_resume_refuses_to_overwrite(self):
+        with self.crash_after(0), self.assertRaises(Crash):
+            self.run_np("-D", "t", "--journal", "journal", *ACTIONS)
+        # d appeared since the run was interrupted.
+        with open(os.path.join("t", "d"), "w") as f:
+            f.write("new")
+        self.run_np("--resume", "journal")
+        contents = self.contents()
+        self.assertEqual(contents["d"], "new")
+        self.assertEqual(contents["E"], "e")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,47 @@
+import os
+import shutil
+import tempfile
+import unittest
+import importlib.util
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+spec = importlib.util.spec_from_file_location(
+    "name_pryer", os.path.join(HERE, os.pardir, "name_pryer.py"))
+np = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(np)
+
+
+class GlobDirectoryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        for path in ("a.txt", "sub/b.txt", "sub/c.md", "sub/deep/d.txt",
+                     "x/sub/e.txt"):
+            path = os.path.join(self.tmp, *path.split("/"))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            open(path, "w").close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def listing(self, *args):
+        config, actions = np.parse_args(["name_pryer", "-D", self.tmp] +
+                                        list(args))
+        return sorted(os.path.relpath(f.origpath(), self.tmp)
+                      for f in np.get_file_listing(config))
+
+    def test_directory_part(self):
+        self.assertEqual(self.listing("-g", "sub/*.txt"),
+                         [os.path.join("sub", "b.txt")])
+
+    def test_directory_part_recursive(self):
+        self.assertEqual(self.listing("-R", "-g", "sub/*.txt"),
+                         [os.path.join("sub", "b.txt"),
+                          os.path.join("x", "sub", "e.txt")])
+
+    def test_missing_directory(self):
+        self.assertEqual(self.listing("-g", "nope/*.txt"), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
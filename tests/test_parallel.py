@@ -0,0 +1,57 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import importlib.util
+from unittest import mock
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+spec = importlib.util.spec_from_file_location(
+    "name_pryer", os.path.join(HERE, os.pardir, "name_pryer.py"))
+np = importlib.util.module_from_spec(spec)
+# The worker processes find their functions by module name.
+sys.modules[spec.name] = np
+spec.loader.exec_module(np)
+
+ACTIONS = ["-s", "su", "-c", "tc", "-p", "{X}", "{num3+2}_{1}",
+           "-p", "{X}", "{1}_{rand1000-9999}", "-r", "_", "-"]
+
+
+class ParallelTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        for d in range(3):
+            path = os.path.join(self.tmp, "dir {}".format(d))
+            os.mkdir(path)
+            for n in range(20):
+                open(os.path.join(path, "some file {}.txt".format(n)),
+                     "w").close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def names(self, *args, actions=ACTIONS):
+        config, actions = np.parse_args(
+            ["name_pryer", "-D", self.tmp, "-R", "--seed", "7",
+             "--num-scope", "dir"] + list(args) + actions)
+        fn_buffer = np.handle_actions(config, actions)
+        return {k: v.full() for k, v in fn_buffer.items()}
+
+    def test_processes_match_serial(self):
+        serial = self.names()
+        self.assertEqual(len(serial), 60)
+        # Chunks smaller than the buffer, so that it is split among the
+        # processes.
+        with mock.patch.object(np, "PARALLEL_CHUNK", 7):
+            self.assertEqual(self.names("-P", "3"), serial)
+
+    def test_processes_detect_duplicates(self):
+        with mock.patch.object(np, "PARALLEL_CHUNK", 7), \
+                self.assertRaises(SystemExit):
+            self.names("-P", "3", actions=ACTIONS + ["-p", "{X}", "same"])
+
+
+if __name__ == "__main__":
+    unittest.main()
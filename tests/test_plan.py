@@ -0,0 +1,51 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+import importlib.util
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+spec = importlib.util.spec_from_file_location(
+    "name_pryer", os.path.join(HERE, os.pardir, "name_pryer.py"))
+np = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(np)
+
+
+class PlanTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        os.chdir(self.tmp)
+        os.mkdir("t")
+        for name in ("a1", "a2"):
+            open(os.path.join("t", name), "w").close()
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp)
+
+    def plan(self, *args):
+        config, actions = np.parse_args(["name_pryer", "-D", "t", "-v", "0",
+                                         "--plan-json", "plan"] + list(args))
+        try:
+            np.run(config, actions)
+        except SystemExit:
+            pass
+        with open("plan") as f:
+            return [json.loads(line) for line in f]
+
+    def test_complete_plan(self):
+        records = self.plan("-y", "-c", "uc")
+        self.assertEqual([os.path.basename(r["new"]) for r in records[:-1]],
+                         ["A1", "A2"])
+        self.assertEqual(records[-1], {"complete": True})
+
+    def test_duplicate_ends_plan_as_incomplete(self):
+        records = self.plan("-y", "-p", "a{#}", "b")
+        self.assertEqual(records[-1], {"complete": False})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,80 @@
+import os
+import shutil
+import tempfile
+import unittest
+import importlib.util
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+spec = importlib.util.spec_from_file_location(
+    "name_pryer", os.path.join(HERE, os.pardir, "name_pryer.py"))
+np = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(np)
+
+
+class PlannerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.config = np.Config()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def path(self, name):
+        return os.path.join(self.tmp, name)
+
+    def write(self, *names):
+        for name in names:
+            with open(self.path(name), "w") as f:
+                f.write(name)
+
+    def contents(self):
+        result = {}
+        for name in os.listdir(self.tmp):
+            with open(self.path(name)) as f:
+                result[name] = f.read()
+        return result
+
+    def apply(self, *renames):
+        np.apply_renames(self.config, [(self.path(old), self.path(new))
+                                       for old, new in renames])
+
+    def test_chain_vacates_targets_first(self):
+        renames = [(self.path("a"), self.path("b")),
+                   (self.path("b"), self.path("c"))]
+        planned, dependencies = np.plan_renames(renames)
+        self.assertEqual(planned, renames[::-1])
+        self.assertEqual(dependencies, [[], [0]])
+
+    def test_chain(self):
+        self.write("a", "b")
+        self.apply(("a", "b"), ("b", "c"))
+        self.assertEqual(self.contents(), {"b": "a", "c": "b"})
+
+    def test_swap(self):
+        self.write("a", "b")
+        renames = [(self.path("a"), self.path("b")),
+                   (self.path("b"), self.path("a"))]
+        planned, dependencies = np.plan_renames(renames)
+        # The cycle is broken with one hop through a temporary name.
+        self.assertEqual(len(planned), 3)
+        self.apply(("a", "b"), ("b", "a"))
+        self.assertEqual(self.contents(), {"a": "b", "b": "a"})
+
+    def test_rotation_with_jobs(self):
+        self.write("a", "b", "c", "d")
+        self.config.jobs = 4
+        self.apply(("a", "b"), ("b", "c"), ("c", "d"), ("d", "a"))
+        self.assertEqual(self.contents(),
+                         {"a": "d", "b": "a", "c": "b", "d": "c"})
+
+    def test_failure_skips_dependents(self):
+        # b cannot take its too long name, so nothing may be renamed onto
+        # it, nor onto a in turn.
+        self.write("a", "b", "z")
+        self.apply(("b", "x" * 300), ("a", "b"), ("z", "a"))
+        self.assertEqual(self.contents(), {"a": "a", "b": "b", "z": "z"})
+
+
+if __name__ == "__main__":
+    unittest.main()
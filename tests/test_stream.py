@@ -0,0 +1,65 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+import importlib.util
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+spec = importlib.util.spec_from_file_location(
+    "name_pryer", os.path.join(HERE, os.pardir, "name_pryer.py"))
+np = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(np)
+
+ACTIONS = ["-M", "b", "-s", "su", "-c", "tc", "-r", "Dir", "Folder"]
+
+
+class StreamTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        os.chdir(self.tmp)
+        for root in ("buffered", "streamed"):
+            for d in range(3):
+                path = os.path.join(root, "some dir {}".format(d),
+                                    "inner dir")
+                os.makedirs(path)
+                for n in range(5):
+                    open(os.path.join(path, "a file {}.txt".format(n)),
+                         "w").close()
+                open(os.path.join(root, "top file {}".format(d)),
+                     "w").close()
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp)
+
+    def run_np(self, root, *args):
+        config, actions = np.parse_args(
+            ["name_pryer", "-D", root, "-R", "-y", "-v", "0",
+             "--plan-json", root + ".plan"] + list(args) + ACTIONS)
+        np.run(config, actions)
+        renames = set()
+        with open(root + ".plan") as f:
+            for line in f:
+                record = json.loads(line)
+                if "old" in record:
+                    renames.add((os.path.relpath(record["old"], root),
+                                 os.path.relpath(record["new"], root)))
+        return renames
+
+    def tree(self, root):
+        return sorted(os.path.relpath(os.path.join(d, n), root)
+                      for d, dirs, files in os.walk(root)
+                      for n in dirs + files)
+
+    def test_stream_matches_buffer(self):
+        renames = self.run_np("buffered")
+        self.assertEqual(len(renames), 3 + 3 + 3 + 15)
+        self.assertEqual(self.run_np("streamed", "--stream"), renames)
+        self.assertEqual(self.tree("streamed"), self.tree("buffered"))
+
+
+if __name__ == "__main__":
+    unittest.main()
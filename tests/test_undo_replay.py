@@ -0,0 +1,102 @@
+import os
+import time
+import subprocess
+import shutil
+import tempfile
+import unittest
+import importlib.util
+from unittest import mock
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+spec = importlib.util.spec_from_file_location(
+    "name_pryer", os.path.join(HERE, os.pardir, "name_pryer.py"))
+np = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(np)
+
+
+class UndoReplayTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        os.chdir(self.tmp)
+        os.makedirs(os.path.join("t", "aaa"))
+        for name in ("f1", "f2"):
+            open(os.path.join("t", "aaa", name), "w").close()
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp)
+
+    def run_np(self, *args):
+        config, actions = np.parse_args(["name_pryer", "-y", "-v", "0"] +
+                                        list(args))
+        np.run(config, actions)
+
+    def tree(self):
+        root = os.path.join(self.tmp, "t")
+        return sorted(os.path.relpath(os.path.join(d, n), self.tmp)
+                      for d, dirs, files in os.walk(root)
+                      for n in dirs + files)
+
+    def make_tree(self, *paths):
+        for path in paths:
+            path = os.path.join("t", path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            open(path, "w").close()
+
+    def test_contents_wait_for_restored_directory(self):
+        t = os.path.join(self.tmp, "t")
+        renames = [(os.path.join(t, "AAA"), os.path.join(t, "aaa")),
+                   (os.path.join(t, "aaa", "F1"),
+                    os.path.join(t, "aaa", "f1"))]
+        self.assertEqual(np.rename_dependencies(renames), [[], [0]])
+
+    def test_replay_with_jobs(self):
+        before = self.tree()
+        self.run_np("-D", "t", "-R", "-M", "b", "-c", "uc", "-u")
+        self.assertIn(os.path.join("t", "AAA", "F1"), self.tree())
+
+        # The directory rename is made slow, so that with several jobs the
+        # moves of its contents would run first if they did not wait for it.
+        renames = os.renames
+
+        def slow_renames(old, new):
+            if os.path.basename(old) == "AAA":
+                time.sleep(0.2)
+            renames(old, new)
+
+        with mock.patch.object(np.os, "renames", slow_renames):
+            self.run_np("-j", "4", "--undo", "undo.sh")
+        self.assertEqual(self.tree(), before)
+
+    def test_undo_directory_chain(self):
+        self.make_tree(os.path.join("d1", "x1"), os.path.join("d2", "x2"))
+        before = self.tree()
+        self.run_np("-D", "t", "-R", "-M", "b", "-r", "d2", "d3",
+                    "-r", "d1", "d2", "-r", "x", "X", "-u")
+        self.assertIn(os.path.join("t", "d3", "X2"), self.tree())
+        self.assertIn(os.path.join("t", "d2", "X1"), self.tree())
+        self.run_np("--undo", "undo.sh")
+        self.assertEqual(self.tree(), before)
+
+    def test_undo_directory_swap(self):
+        self.make_tree(os.path.join("da", "xa"), os.path.join("db", "xb"))
+        before = self.tree()
+        self.run_np("-D", "t", "-R", "-M", "b", "-r", "da", "dc",
+                    "-r", "db", "da", "-r", "dc", "db", "-r", "x", "X", "-u")
+        self.assertIn(os.path.join("t", "db", "Xa"), self.tree())
+        self.run_np("-j", "4", "--undo", "undo.sh")
+        self.assertEqual(self.tree(), before)
+
+    def test_undo_directory_swap_with_sh(self):
+        self.make_tree(os.path.join("da", "xa"), os.path.join("db", "xb"))
+        before = self.tree()
+        self.run_np("-D", "t", "-R", "-M", "b", "-r", "da", "dc",
+                    "-r", "db", "da", "-r", "dc", "db", "-r", "x", "X", "-u")
+        subprocess.run(["sh", "undo.sh"], check=True)
+        self.assertEqual(self.tree(), before)
+
+
+if __name__ == "__main__":
+    unittest.main()